@@ -0,0 +1,55 @@
+'''Per-call cost of Path.format / partial_format / glob_pattern.
+
+Compares the compiled templates against formatting the raw pattern string
+each call (the pre-template implementation).
+
+    python benchmarks/bench_format.py [-n 100000]
+'''
+import timeit
+import argparse
+from pformat import pformat, gformat
+import pathtree
+
+
+def legacy_format(path, **kw):
+    return path.path_pattern.format(**{**path.path_data, **kw})
+
+def legacy_partial_format(path, **kw):
+    return pformat(path.path_pattern, **{**path.path_data, **kw})
+
+def legacy_glob_pattern(path):
+    return gformat(path.path_pattern, **path.path_data)
+
+
+def main(n=100000):
+    paths = pathtree.tree('logs', {
+        '{log_id}': {
+            'plots': {'epoch_{i_epoch:04d}': {'{plot_name}.png': 'plot'}},
+            'models': {'{step_name}.h5': 'model_step'},
+        },
+    }).specify(log_id='a')
+    plot = paths.plot.specify(i_epoch=5)
+    model_step = paths.model_step
+
+    cases = [
+        ('format', lambda: legacy_format(plot, plot_name='f1'),
+                   lambda: plot.format(plot_name='f1')),
+        ('format (model_step)', lambda: legacy_format(model_step, step_name='x'),
+                                lambda: model_step.format(step_name='x')),
+        ('partial_format', lambda: legacy_partial_format(plot),
+                           lambda: plot.partial_format()),
+        ('glob_pattern', lambda: legacy_glob_pattern(plot),
+                         lambda: plot.glob_pattern),
+    ]
+    print('{:<22} {:>12} {:>12} {:>8}'.format('operation', 'legacy (us)', 'compiled (us)', 'speedup'))
+    for name, legacy, compiled in cases:
+        assert legacy() == compiled(), name
+        t0 = min(timeit.repeat(legacy, number=n, repeat=3)) / n * 1e6
+        t1 = min(timeit.repeat(compiled, number=n, repeat=3)) / n * 1e6
+        print('{:<22} {:>12.2f} {:>12.2f} {:>7.1f}x'.format(name, t0, t1, t0 / t1))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', type=int, default=100000)
+    main(**vars(parser.parse_args()))
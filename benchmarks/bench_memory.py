@@ -0,0 +1,93 @@
+'''Memory used building and copying a large tree (tracemalloc).
+
+Compares against a copy of the pre-copy-on-write implementation (a ``Path``
+per name holding a ``pathlib.Path`` and its own data dict, copied eagerly).
+
+    python benchmarks/bench_memory.py [-n 10000]
+
+To compare two real checkouts instead, run it with each one first on the
+path (``PYTHONPATH=/path/to/checkout python benchmarks/bench_memory.py``).
+'''
+import gc
+import pathlib
+import argparse
+import tracemalloc
+import pathtree
+from run import spec
+
+
+class LegacyPath(object):
+    '''The old Path: a pathlib.Path and a data dict per object.'''
+    def __init__(self, *path, data=None, parent=None):
+        self._path = pathlib.Path(*path)
+        self.data = {} if data is None else data
+        self.parent = parent
+
+    @property
+    def copy(self):
+        return LegacyPath(self._path, data=dict(self.data), parent=self.parent)
+
+
+class LegacyPaths(object):
+    '''The old Paths: every path built up front and copied with the collection.'''
+    def __init__(self, paths, data=None):
+        self.paths = paths
+        self.data = {} if data is None else data
+        for path in paths.values():
+            path.parent = self
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __getitem__(self, name):
+        return self.paths[name]
+
+    def specify(self, **kw):
+        return LegacyPaths({name: p.copy for name, p in self.paths.items()}, dict(self.data, **kw))
+
+def legacy_tree(root, paths):
+    return LegacyPaths(
+        {v: LegacyPath(*k) for k, v in pathtree.path.get_keys({'{root}': {'': 'root', **paths}})},
+        {'root': root})
+
+
+def measure(func):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = func()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, current, peak
+
+
+def run(tree, s):
+    paths, cur, peak = measure(lambda: tree('logs', s))
+    rows = [('tree()', cur, peak)]
+    # access every path so it's built
+    _, cur, peak = measure(lambda: [paths[name] for name in paths])
+    rows.append(('access all', cur, peak))
+    _, cur, peak = measure(lambda: [paths[name].copy for name in paths])
+    rows.append(('copy each path', cur, peak))
+    _, cur, peak = measure(lambda: [paths.specify(log_id=i) for i in range(10)])
+    rows.append(('specify x10', cur, peak))
+    return rows
+
+
+def main(n=10000):
+    s = spec(n)
+    legacy, current = run(legacy_tree, s), run(pathtree.tree, s)
+
+    print('{} named paths (KiB)'.format(n + 1))
+    print('{:<16} {:>15} {:>15} {:>15} {:>15}'.format(
+        'operation', 'legacy retained', 'retained', 'legacy peak', 'peak'))
+    for (name, cur0, peak0), (_, cur1, peak1) in zip(legacy, current):
+        print('{:<16} {:>15.1f} {:>15.1f} {:>15.1f} {:>15.1f}'.format(
+            name, cur0 / 1024, cur1 / 1024, peak0 / 1024, peak1 / 1024))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', type=int, default=10000)
+    main(**vars(parser.parse_args()))
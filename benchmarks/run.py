@@ -0,0 +1,192 @@
+'''Benchmark suite: time and peak memory of the hot operations on synthetic
+specs and on-disk trees. Results are written as JSON so runs can be compared
+between commits.
+
+    python benchmarks/run.py -o before.json          # on the old commit
+    python benchmarks/run.py -o after.json           # on the new commit
+    python benchmarks/run.py --compare before.json after.json
+
+To benchmark another checkout, put it first on the path
+(``PYTHONPATH=/path/to/checkout python benchmarks/run.py``). On-disk trees
+are created under /dev/shm (tmpfs) when it exists, so disk speed doesn't
+dominate. Use ``--files 1000 1000000`` for the big trees.
+'''
+import os
+import gc
+import sys
+import json
+import time
+import shutil
+import timeit
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+
+
+def spec(n, width=10):
+    '''A synthetic spec with ``n`` named leaves, ``width`` leaves per directory.'''
+    groups = {}
+    for i in range(n):
+        group = groups.setdefault('group{}'.format(i // width), {'{step_name}': {}})
+        group['{step_name}']['file{}_{{name}}.csv'.format(i)] = 'f{}'.format(i)
+    return {'{log_id}': groups}
+
+
+DISK_SPEC = {'{group}': {'{step:04d}': {'{i}.txt': 'file'}}}
+
+def make_files(root, n, per_dir=100, steps=10):
+    '''Create ``n`` empty files matching ``DISK_SPEC`` under root.'''
+    for j in range(0, n, per_dir):
+        d = os.path.join(root, 'g{}'.format(j // (per_dir * steps)), '{:04d}'.format(j // per_dir % steps))
+        os.makedirs(d, exist_ok=True)
+        for i in range(j, min(j + per_dir, n)):
+            open(os.path.join(d, '{}.txt'.format(i)), 'w').close()
+
+
+'''
+
+Measuring
+
+'''
+
+def measure(func, setup=None, repeat=3, min_time=0.2):
+    '''Time ``func`` (best per-call seconds) and its peak traced memory.
+
+    ``setup`` is run before every call when given (and the call is timed
+    once per repeat), otherwise the call is looped for at least ``min_time``.
+    '''
+    if setup is not None:
+        times = []
+        for _ in range(repeat):
+            setup()
+            t0 = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - t0)
+        seconds = min(times)
+        setup()
+    else:
+        timer = timeit.Timer(func)
+        number, _ = timer.autorange()
+        number = max(1, int(number * min_time / 0.2))
+        seconds = min(timer.repeat(repeat, number)) / number
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return seconds, peak
+
+
+def spec_cases(n):
+    import pathtree
+    s = spec(n)
+    paths = pathtree.tree('logs', s)
+    specified = paths.specify(log_id='a', step_name='b')
+    last = paths['f{}'.format(n - 1)]
+    f = last.format(log_id='a', step_name='b', name='c')
+    yield 'tree', lambda: pathtree.tree('logs', s), None
+    yield 'specify', lambda: paths.specify(log_id='a'), None
+    yield 'format', lambda: last.format(log_id='a', step_name='b', name='c'), None
+    yield 'partial_format', lambda: last.partial_format(), None
+    yield 'paths.format', lambda: specified.format(), None
+    yield 'parse', lambda: last.parse(f), None
+    if hasattr(paths, 'match'):
+        yield 'match', lambda: paths.match(f), None
+
+
+def disk_cases(root, n):
+    import pathtree
+    paths = pathtree.tree(root, DISK_SPEC)
+    make_files(root, n)
+    yield 'glob', lambda: paths.file.glob(), None
+    yield 'glob (one dir)', lambda: paths.file.specify(group='g0', step=3).glob(), None
+    yield 'parse glob', lambda: [paths.file.parse(f) for f in paths.file.glob()], None
+    yield 'rmglob', lambda: paths.root.rmglob(include=True), lambda: (
+        os.path.isdir(root) or make_files(root, n))
+
+
+def run(sizes=(10, 100, 1000, 10000), files=(1000, 10000), tmp=None, repeat=3, only=None, verbose=True):
+    results = []
+    def record(group, size, name, func, setup):
+        if only and not any(o in name for o in only):
+            return
+        seconds, peak = measure(func, setup, repeat=repeat)
+        results.append({'group': group, 'size': size, 'name': name, 'seconds': seconds, 'peak_kib': peak / 1024})
+        if verbose:
+            print('{:<6} {:>8} {:<16} {:>12.2f} us {:>10.1f} KiB'.format(
+                group, size, name, seconds * 1e6, peak / 1024), flush=True)
+
+    for n in sizes:
+        for name, func, setup in spec_cases(n):
+            record('spec', n, name, func, setup)
+
+    tmp = tmp or ('/dev/shm' if os.path.isdir('/dev/shm') else None)
+    for n in files:
+        base = tempfile.mkdtemp(prefix='pathtree-bench-', dir=tmp)
+        try:
+            for name, func, setup in disk_cases(os.path.join(base, 'tree'), n):
+                record('disk', n, name, func, setup)
+        finally:
+            shutil.rmtree(base, ignore_errors=True)
+    return {'meta': meta(), 'results': results}
+
+
+def meta():
+    import pathtree
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(pathtree.__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'pathtree': os.path.dirname(os.path.abspath(pathtree.__file__)),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def compare(before, after, threshold=0.1):
+    '''Print the change in time and memory for each benchmark in both files.
+    Returns the number of regressions (slower by more than ``threshold``).'''
+    load = lambda f: {(r['group'], r['size'], r['name']): r for r in json.load(open(f))['results']}
+    a, b = load(before), load(after)
+    print('{:<6} {:>8} {:<16} {:>12} {:>12} {:>8} {:>8}'.format(
+        'group', 'size', 'name', 'before (us)', 'after (us)', 'time', 'memory'))
+    regressions = 0
+    for key in (k for k in a if k in b):
+        ra, rb = a[key], b[key]
+        ratio = rb['seconds'] / ra['seconds']
+        mem = rb['peak_kib'] / ra['peak_kib'] if ra['peak_kib'] else float('nan')
+        slower = ratio > 1 + threshold
+        regressions += slower
+        print('{:<6} {:>8} {:<16} {:>12.2f} {:>12.2f} {:>7.2f}x {:>7.2f}x{}'.format(
+            *key, ra['seconds'] * 1e6, rb['seconds'] * 1e6, ratio, mem, '  <- slower' if slower else ''))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    parser.add_argument('--sizes', type=int, nargs='*', default=[10, 100, 1000, 10000], help='named paths in the synthetic specs')
+    parser.add_argument('--files', type=int, nargs='*', default=[1000, 10000], help='files in the on-disk trees')
+    parser.add_argument('--tmp', help='where to create the on-disk trees (default: /dev/shm if it exists)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('-k', '--only', nargs='*', help='only run benchmarks with these names')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compare two result files')
+    parser.add_argument('--threshold', type=float, default=0.1, help='report slowdowns bigger than this (with --compare)')
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, threshold=args.threshold) else 0)
+    out = run(args.sizes, args.files, args.tmp, args.repeat, args.only)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(out, f, indent=2)
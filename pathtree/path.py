@@ -1,14 +1,24 @@
 import os
-import glob
-import pathlib
+import sys
+import time
+import stat
 import itertools
-from functools import wraps
-import inspect
-from parse import parse as parse_
-from pformat import *
+import threading
+import contextvars
+import contextlib
+from functools import wraps, lru_cache
+import _string
+from collections.abc import MutableMapping, Collection
+# parse, pformat, pathlib, glob, re, mmap and inspect are imported when
+# they're first needed so that importing pathtree stays fast
 
 __all__ = ['Paths', 'Path', 'tree', 'UnderspecifiedError']
 
+# the max number of value combinations to check directly in Path.scan/glob before
+# falling back to listing directories.
+MAX_PROBES = 256
+
+
 def tree(root='.', paths=None, data=None):
     '''Build paths from a directory spec.
 
@@ -24,13 +34,30 @@ def tree(root='.', paths=None, data=None):
     paths = paths or {}
     if isinstance(paths, (list, tuple, set)):
         paths = {k: k for k in paths}
-    return Paths(
-        {v: Path(*k) for k, v in get_keys({'{root}': {'': 'root', **paths}})},
-        dict(data or {}, root=root))
+    # store the path definitions - Path objects are created when accessed
+    return Paths(PathMap.from_source({
+        name: (pattern, EMPTY) for name, pattern in _walk_spec({'{root}': {'': 'root', **paths}})
+    }), dict(data or {}, root=root))
+
+
+def _walk_spec(spec, prefix=None):
+    '''Get ``(name, pattern)`` for each leaf in a nested spec, joining each
+    directory's pattern once (the same as ``_join_pattern(*keys)``).'''
+    for key, value in spec.items():
+        if prefix is None:
+            pattern = _join_pattern(key)
+        elif os.sep == '/' and '/' not in key and key not in ('', '.') and prefix not in ('.', '/', '//'):
+            pattern = sys.intern(prefix + '/' + key)  # prefix is already normalized
+        else:
+            pattern = _join_pattern(prefix, key)
+        if isinstance(value, dict):
+            yield from _walk_spec(value, pattern)
+        else:
+            yield value, pattern
 
 
 def parse(pattern, s):
-    r = parse_(pattern, s)
+    r = compile_parser(pattern).parse(s)
     return r and r.named
 
 
@@ -66,15 +93,27 @@ class Paths(object):
 
     '''
     _paths = None
+    _indexes = None
+    _formatted = None
     def __init__(self, paths, data=None):
-        self._paths = paths
-        self.data = {} if data is None else data
+        self._paths = paths if isinstance(paths, PathMap) else PathMap(paths)
+        self._paths.bind(self)
+        self.data = data
+        self._indexes = {}
+        self._formatted = None, None
 
-        for path in self._paths.values():
-            path.parent = self
+    @property
+    def data(self):
+        '''The data shared by all paths. This is a copy-on-write ``Scope``,
+        not a dict - use ``dict(paths.data)`` if you need one (e.g. for json).'''
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data if isinstance(data, Scope) else Scope(data)
 
-    @wraps(tree)
     @classmethod
+    @wraps(tree)
     def define(cls, *a, **kw):
         return tree(*a, **kw)
 
@@ -85,8 +124,8 @@ class Paths(object):
 
     @property
     def copy(self):
-        return Paths({name: path.copy for name, path in self.paths.items()},
-                     dict(self.data))
+        '''Create a copy. Unmodified paths and data are shared until they're changed.'''
+        return Paths(self._paths.copy(), self.data.fork())
 
     def add(self, root, paths):
         '''Build paths from a directory spec.
@@ -102,18 +141,17 @@ class Paths(object):
         paths = paths if isinstance(paths, Paths) else tree(paths)
 
         # add paths to
-        self.paths.update(**{
-            k: p.repath(p.format_only(root=root))
-            for k, p in paths.paths.items()})
+        added = {k: p.repath(p.format_only(root=root)) for k, p in paths.paths.items()}
+        self.paths.update(**added)
 
-        for path in paths.paths.values():
+        for path in added.values():
             path.parent = self
+        self._changed()
         return self
 
     def __repr__(self):
         return '<Paths data={} \n{}\n>'.format(self.data, '\n'.join([
-            '\t{} : {}'.format(name, self[name].maybe_format())
-            for name in self.paths
+            '\t{} : {}'.format(name, f) for name, f in self.partial_format().items()
         ]))
 
     def __contains__(self, path):
@@ -125,8 +163,48 @@ class Paths(object):
     def __getitem__(self, name):
         return self._paths[name]
 
+    def __reduce__(self):
+        # pickle the path definitions (shared between copies), the data and
+        # the paths changed in place - not every Path object and cache
+        m = self._paths
+        changed = {**m.overlay, **{name: _path_def(m.bound[name]) for name in m.modified}}
+        return _unpickle_paths, (type(self), m.source, changed, dict(self.data))
+
+    def map(self, func, records, workers=None, backend='process', chunksize=1):
+        '''Call ``func(paths.specify(**record))`` for each record in parallel.
+
+        .. code-block:: python
+
+            def train(paths):
+                ...
+                return paths.model.format()
+
+            models = paths.map(train, [{'log_id': i} for i in range(100)], workers=8)
+
+        With the process backend, the paths and ``func`` are sent to each worker
+        once (so ``func`` must be picklable) and each task only sends its record.
+
+        Arguments:
+            func (callable): the function to call.
+            records (iterable): dicts of data to specify for each call.
+            workers (int): the number of workers (default: the number of CPUs).
+            backend (str): 'process' or 'thread'.
+            chunksize (int): how many records to send to a process at a time.
+
+        Returns:
+            list: the results in the same order as ``records``.
+        '''
+        from concurrent import futures
+        if backend == 'thread':
+            with futures.ThreadPoolExecutor(workers) as pool:
+                return list(pool.map(lambda record: func(self.specify(**record)), records))
+        if backend != 'process':
+            raise ValueError("Unknown backend {!r}. Use 'process' or 'thread'.".format(backend))
+        with futures.ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(self, func)) as pool:
+            return list(pool.map(_run_worker, records, chunksize=chunksize))
+
     def __getattr__(self, name):
-        if name != '_paths' and self._paths and name in self._paths:
+        if name not in ('_paths', '_data') and self._paths and name in self._paths:
             return self._paths[name]
         raise AttributeError(name)
 
@@ -139,16 +217,272 @@ class Paths(object):
         '''
         return self[name].parse(path)
 
+    def match(self, path, use_data=True):
+        '''Find which named pattern a path belongs to.
+
+        Candidate patterns are looked up by their literal suffix/prefix in a
+        precomputed index, so only the few plausible patterns are parsed.
+        If several patterns match, the most specific one (with the most literal
+        characters) wins.
+
+        Arguments:
+            path (str): the string to match.
+            use_data (bool): fill specified keys before matching. See ``Path.parse``.
+
+        Returns:
+            name (str): the name of the matching path pattern.
+            data (dict): the data parsed from the path.
+
+        Raises:
+            ValueError if no pattern matches.
+        '''
+        m = self._index(use_data).match(path)
+        if m is None:
+            raise ValueError('Could not match path to any pattern: {}'.format(path))
+        return m
+
+    def match_many(self, paths, use_data=True, errors='raise'):
+        '''Match many paths, yielding ``(path, name, data)``.
+
+        Arguments:
+            paths (iterable): the strings to match.
+            use_data (bool): fill specified keys before matching. See ``Path.parse``.
+            errors (str): what to do with paths that don't match. ``'raise'``
+                raises a ValueError, ``'skip'`` leaves them out.
+        '''
+        index = self._index(use_data)
+        for path in paths:
+            m = index.match(path)
+            if m is None:
+                if errors == 'skip':
+                    continue
+                raise ValueError('Could not match path to any pattern: {}'.format(path))
+            yield (path,) + m
+
+    def _index(self, use_data=True):
+        '''Get the pattern index, building it if the paths have changed.'''
+        version, index = self._indexes.get(use_data, (None, None))
+        if version != self.data.version:
+            index = PatternIndex(
+                (name, p.partial_format() if use_data else p.path_pattern, p.path_data)
+                for name, p in self.paths.items())
+            self._indexes[use_data] = self.data.version, index
+        return index
+
+    def _changed(self, path=None):
+        '''Drop anything cached from the current paths/data. If ``path`` is
+        given, only if it's one of the paths in this collection.'''
+        if path is None or self._paths.touch(path):
+            self._indexes.clear()
+            self._formatted = None, None
+
     def translate(self, file, form, to, **kw):
         return self[to].specify(**self[form].parse(file, **kw))
 
-    def makedirs(self):
-        '''Instantiate all fully specified directories.'''
-        for path in self.paths.values():
+    def translate_many(self, files, from_, to, use_data=True, errors='raise'):
+        '''Translate many files from one named pattern to another, yielding
+        the translated paths as strings.
+
+        The source parser and target template are compiled once and no
+        ``Path`` objects are created. The result is the same as
+        ``translate(file, from_, to).format()``.
+
+        .. code-block:: python
+
+            csvs = list(paths.translate_many(flac_files, 'flac', 'csv'))
+
+        Arguments:
+            files (iterable): the files to translate.
+            from_ (str): the name of the pattern to parse the files with.
+            to (str): the name of the pattern to format.
+            use_data (bool): fill specified keys before parsing. See ``Path.parse``.
+            errors (str): what to do with files that don't match ``from_``.
+                ``'raise'`` raises a ValueError, ``'skip'`` leaves them out
+                and ``'none'`` yields None in their place (so the output lines
+                up with the input).
+        '''
+        if errors not in ('raise', 'skip', 'none'):
+            raise ValueError("errors must be 'raise', 'skip' or 'none', got {!r}".format(errors))
+        src, dst = self[from_], self[to]
+        pattern = src.partial_format() if use_data else src.path_pattern
+        parser = compile_parser(pattern)
+        # parsed values, then the source's data, then the target's (like specify)
+        data, to_data = src.path_data, dst.data
+        fmt = dst.template.format
+        for f in files:
+            r = parser.parse(os.fspath(f))
+            if r is None:
+                if errors == 'raise':
+                    raise _parse_error(f, pattern)
+                if errors == 'none':
+                    yield None
+                continue
             try:
-                path.make(up=1)
-            except UnderspecifiedError:
-                pass
+                yield fmt((r.named, data, to_data))
+            except KeyError as e:
+                raise UnderspecifiedError(str(e))
+
+    def migrate(self, from_, to, mode='move', workers=8, journal=None, chunk=1000, overwrite=False, **constraints):
+        '''Move, copy or hardlink every file matching one named path to the
+        matching location of another.
+
+        Matches are streamed in chunks (see ``Path.scan`` - files that don't
+        parse are left alone). For each chunk the destination
+        directories are created once and the operations run on a thread pool.
+        Moves use ``os.replace`` and fall back to copy + delete when the
+        destination is on another device (hardlinks fall back to copies).
+
+        Before running a chunk, its destinations are checked: if two files
+        map to the same destination a ValueError is raised, and if a
+        destination already exists (and ``overwrite`` is False) a
+        FileExistsError is raised. Chunks that already ran are left as they are.
+
+        .. code-block:: python
+
+            paths = pathtree.tree('logs', {'{log_id}': {
+                'plots/{step_name}/{plot_name}.png': 'plot',
+                'figures/{plot_name}/{step_name}.png': 'figure',
+            }})
+            paths.migrate('plot', 'figure', journal='migrate.jsonl')
+
+        Arguments:
+            from_ (str): the name of the path to find the files with.
+            to (str): the name of the path to move them to.
+            mode (str): ``'move'``, ``'copy'`` or ``'hardlink'``.
+            workers (int): the number of threads. 0 or None to run serially,
+                which can be faster for moves on a local disk.
+            journal (str): a JSONL file recording each finished file. Files
+                already in it are skipped, so an interrupted migration can be
+                resumed by running it again with the same journal.
+            chunk (int): how many files to translate and run at a time.
+            overwrite (bool): replace destinations that already exist.
+            **constraints: limit the matched files. See ``Path.glob``.
+
+        Returns:
+            dict: the number of ``files`` migrated, and of files ``skipped``
+            because the journal already had them.
+        '''
+        if mode not in _MIGRATE:
+            raise ValueError("mode must be one of {}, got {!r}".format(', '.join(map(repr, _MIGRATE)), mode))
+        op = _MIGRATE[mode]
+        import json
+        done, seen = set(), set()  # sources already migrated, destinations used
+        if journal and os.path.isfile(journal):
+            with _open(journal) as fh:
+                for l in fh:
+                    if l.strip():
+                        entry = json.loads(l)
+                        done.add(entry['src'])
+                        seen.add(os.path.abspath(entry['dst']))
+        counts = {'files': 0, 'skipped': 0}
+        # only files that parse, with their data (so they're not parsed again)
+        files = self[from_].scan(sort=False, **constraints)
+        fmt, to_data = self[to].template.format, self[to].data
+
+        pool = None
+        if workers:
+            from concurrent.futures import ThreadPoolExecutor
+            pool = ThreadPoolExecutor(workers)
+        log = _open(journal, 'a') if journal else None
+        try:
+            while True:
+                found = list(itertools.islice(files, chunk))
+                if not found:
+                    break
+                try:
+                    pairs = [(f, fmt((data, to_data))) for f, data in found if f not in done]
+                except KeyError as e:
+                    raise UnderspecifiedError(str(e))
+                counts['skipped'] += len(found) - len(pairs)
+                for src, dst in pairs:
+                    key = os.path.abspath(dst)
+                    if key in seen:
+                        raise ValueError('More than one file maps to {} (including {})'.format(dst, src))
+                    seen.add(key)
+                if not overwrite:
+                    existing = [
+                        dst for src, dst in pairs if os.path.lexists(dst)
+                        # already linked by an interrupted run
+                        and not (op is _link_file and os.path.samefile(src, dst))]
+                    if existing:
+                        raise FileExistsError('{} destination(s) already exist, e.g. {}. Pass overwrite=True to replace them.'.format(
+                            len(existing), existing[0]))
+                # not skipping dirs seen before - they may have been removed since
+                makedirs({os.path.dirname(dst) or '.' for _, dst in pairs}, cache=False)
+                for src, dst in (pool.map(op, pairs) if pool is not None else map(op, pairs)):
+                    if log is not None:
+                        log.write(json.dumps({'src': src, 'dst': dst}) + '\n')
+                    counts['files'] += 1
+                if log is not None:
+                    log.flush()
+        finally:
+            if pool is not None:
+                pool.shutdown()
+            if log is not None:
+                log.close()
+        return counts
+
+    def makedirs(self, workers=None, cache=True):
+        '''Instantiate all fully specified directories.
+
+        Each parent directory is only created once, directories that are
+        ancestors of other directories are skipped (``os.makedirs`` creates them),
+        and directories that were already created by this process are skipped.
+
+        Arguments:
+            workers (int): create the directories using a thread pool.
+            cache (bool): skip directories this process has already created. Set
+                to False if they may have been removed by something else.
+        '''
+        tree = self._paths.tree()
+        names = self._paths.with_data() if tree is not None else self._paths
+        dirs = tree.parent_dirs(self.data.flat) if tree is not None else set()
+        for name in names:
+            path = self[name].up()
+            if path.fully_specified:
+                dirs.add(path.format())
+        makedirs(dirs, workers=workers, cache=cache)
+
+    def snapshot(self, ttl=None):
+        '''Cache filesystem checks (``exists``, ``is_file``, ``is_dir``) and
+        directory listings (``scan``) while in a ``with`` block.
+
+        .. code-block:: python
+
+            with paths.snapshot():
+                missing = [name for name in paths if not paths[name].exists()]
+
+        Writes made through ``Path`` methods (write, touch, rm, move, ...)
+        update the cache. See ``StatCache``.
+
+        Arguments:
+            ttl (float): how many seconds to trust a cached result for.
+        '''
+        return StatCache(ttl)
+
+    def writers(self, max_open=512, flush_every=1., buffering=-1, **kw):
+        '''Keep files open for appending while in a ``with`` block.
+
+        .. code-block:: python
+
+            with paths.writers() as pool:
+                for step in range(1000):
+                    for name in names:
+                        pool.append(paths.result_step, line, step_name=name)
+
+        Files are opened once (and their directories created once) instead
+        of on every write. See ``WriterPool``.
+
+        Arguments:
+            max_open (int): the most files to keep open (keep it below
+                ``ulimit -n``). The least recently used file is closed when
+                another one is needed.
+            flush_every (float): flush all open files at most this many seconds
+                apart. None to only flush when files are closed.
+            buffering (int): passed to ``open``.
+            **kw: passed to ``open`` (e.g. ``encoding``).
+        '''
+        return WriterPool(max_open, flush_every, buffering, **kw)
 
     def update(self, **kw):
         '''Update format data in place.'''
@@ -172,6 +506,16 @@ class Paths(object):
         '''Are all paths fully specified?'''
         return all(p.fully_specified for p in self.paths.values())
 
+    def missing_fields(self):
+        '''Get the fields that are missing data for each path that isn't fully specified.'''
+        missing = ((name, p.missing_fields()) for name, p in self.paths.items())
+        return {name: fields for name, fields in missing if fields}
+
+    def requires(self, field):
+        '''Get the names of the paths whose pattern uses a field.'''
+        return [name for name, (pattern, _) in self._paths.source.items()
+                if field in compile_pattern(pattern).fields]
+
     def format(self, **kw):
         '''Return a dictionary where all fully specified paths are converted to strings
         and underspecified strings are left as Path objects.
@@ -179,7 +523,8 @@ class Paths(object):
         Arguments:
             **kw: additional data specified for formatting.
         '''
-        return {name: self[name].maybe_format(**kw) for name in self}
+        return {name: f if complete else self[name].specify(**kw)
+                for name, (f, complete) in self._format_all(kw).items()}
 
     def partial_format(self, **kw):
         '''Return a dictionary where all paths are converted to strings
@@ -188,13 +533,406 @@ class Paths(object):
         Arguments:
             **kw: additional data specified for formatting.
         '''
-        return {name: self[name].partial_format(**kw) for name in self}
+        return {name: f for name, (f, _) in self._format_all(kw).items()}
+
+    def _format_all(self, kw):
+        '''Partially format every path, formatting shared directories only once.
+
+        Returns:
+            dict of name -> (partially formatted string, is fully specified)
+        '''
+        if not kw:
+            # the data of paths with their own data can also be changed directly
+            bound = self._paths.bound
+            key = self.data.version, [
+                (name, dict(bound[name].data)) for name in self._paths.with_data() if name in bound]
+            cached, formatted = self._formatted
+            if cached == key:
+                return formatted
+
+        tree = self._paths.tree()
+        if tree is None:  # some patterns can't be split into components
+            names, formatted = self._paths, {}
+        else:
+            names = self._paths.with_data()  # paths with their own data
+            formatted = tree.partial_format({**self.data.flat, **kw} if kw else self.data.flat)
+        for name in names:
+            f = self[name].maybe_format(**kw)
+            formatted[name] = (f, True) if isinstance(f, str) else (f.partial_format(), False)
+        if not kw:
+            self._formatted = key, formatted
+        return formatted
+
+    def globs(self, *names, **constraints):
+        '''Glob multiple named paths. See ``Path.glob`` for ``constraints``.'''
+        return [f for p, c in self._constrain(names, constraints) for f in p.glob(**c)]
+
+    def _constrain(self, names, constraints):
+        '''Give each named path the constraints on its own fields. Raises
+        KeyError for constraints that aren't a field of any of them.'''
+        paths = [self[name] for name in names]
+        fields = [compile_pattern(p.path_pattern).fields for p in paths]
+        unknown = set(constraints).difference(*fields)
+        if paths and unknown:
+            raise KeyError('Unknown fields {} for paths {}'.format(', '.join(sorted(unknown)), ', '.join(names)))
+        return [(p, {k: v for k, v in constraints.items() if k in fs}) for p, fs in zip(paths, fields)]
+
+    @contextlib.contextmanager
+    def mmap_glob(self, *names, mode='r', **constraints):
+        '''Memory-map all files matching multiple named paths. Yields
+        ``{file: mmap}``. See ``Path.mmap`` and ``Path.glob``.'''
+        with contextlib.ExitStack() as stack:
+            yield {f: m for p, c in self._constrain(names, constraints) for f, m in stack.enter_context(
+                p.mmap_glob(mode=mode, **c)).items()}
+
+    def write_many(self, name, items, mode='', workers=8, **kw):
+        '''Write many files for a named path. See ``Path.write_many``.'''
+        return self[name].write_many(items, mode=mode, workers=workers, **kw)
+
+    def read_many(self, name, items, mode='', workers=8, ordered=True, **kw):
+        '''Read many files for a named path. See ``Path.read_many``.'''
+        return self[name].read_many(items, mode=mode, workers=workers, ordered=ordered, **kw)
+
+    def index(self, *names, db=':memory:'):
+        '''Scan the files matching named paths into a SQLite index so they can
+        be queried without touching the filesystem again.
+
+        .. code-block:: python
+
+            index = paths.index('flac', 'csv', db='files.db')
+            index.query('flac', date='2020-*')  # [(file, data), ...]
+            index.distinct('date')
+            index.refresh(paths)  # only lists directories that changed
+
+        Arguments:
+            *names: the path names to index. Defaults to all paths.
+            db (str): the SQLite database file. Rows for these names are replaced.
+
+        Returns:
+            FileIndex
+        '''
+        index = FileIndex(db)
+        for name in names or list(self.paths):
+            listing = self[name].listing(name)
+            index.add(name, listing.files.items(), self[name].template.fields)
+            index._save_dirs(name, listing.dirs)
+        return index
+
+    def stats(self, reset=False):
+        '''Get the operation counts, timings, filesystem calls and cache hit
+        rates recorded since instrumentation was enabled (or last reset).
+        This covers all of pathtree, not only this collection.
+
+        .. code-block:: python
+
+            with pathtree.path.instrument:  # or instrument.enable(sample=100, hook=print)
+                ...
+            paths.stats()['ops']['format']
+
+        See ``pathtree.path.Instrument``.
+        '''
+        return instrument.report(reset=reset)
+
+    async def aglobs(self, *names, **constraints):
+        '''Async version of ``globs`` - the names are globbed concurrently.'''
+        fss = await _gather(lambda pc: pc[0].glob(**pc[1]), self._constrain(names, constraints))
+        return [f for fs in fss for f in fs]
+
+    async def aexists(self, *names, limit=None):
+        '''Check if (fully specified) paths exist concurrently.
+
+        Arguments:
+            *names: path names or ``Path`` objects. Defaults to all fully specified paths.
+            limit (int): the max number of checks in flight (default: the executor size).
+
+        Returns:
+            dict: ``{name_or_path: exists}``
+        '''
+        names = names or [k for k in self.paths if self[k].fully_specified]
+        found = await _gather(lambda p: self._as_path(p).exists(), names, limit)
+        return dict(zip(names, found))
+
+    async def aread_many(self, paths, mode='', limit=None, **kw):
+        '''Read many files concurrently, in order.
+
+        Arguments:
+            paths (iterable): path names, ``Path`` objects or strings.
+            limit (int): the max number of reads in flight (default: the executor size).
+        '''
+        return await _gather(lambda p: self._as_path(p).read(mode, **kw), paths, limit)
+
+    async def awrite_many(self, items, mode='', limit=None, **kw):
+        '''Write many files concurrently.
+
+        Arguments:
+            items (iterable): ``(path, content)`` pairs, where path is a path
+                name, a ``Path`` object or a string.
+            limit (int): the max number of writes in flight (default: the executor size).
+        '''
+        return await _gather(lambda x: self._as_path(x[0]).write(x[1], mode, **kw), items, limit)
+
+    def _as_path(self, p):
+        return p if isinstance(p, Path) else self[p] if p in self.paths else Path(p)
+
+
+def _unpickle_paths(cls, source, changed, data):
+    m = PathMap.from_source(source)
+    m._shared = True  # the source may be shared with other unpickled copies
+    m.overlay = changed
+    return cls(m, data)
+
+# the paths and function used by Paths.map in a worker process
+_worker = None
+
+def _init_worker(paths, func):
+    global _worker
+    _worker = paths, func
+
+def _run_worker(record):
+    paths, func = _worker
+    return func(paths.specify(**record))
+
+
+class Scope(MutableMapping):
+    '''Layered, copy-on-write data for a Paths collection.
+
+    Writes go to a local dict. ``fork()`` freezes the local dict into the
+    shared (read-only) layers and returns a new scope on top of them, so
+    copying is O(1) and specifying a key only touches that key. Every change
+    gets a new ``version`` which can be used to invalidate caches.
+
+    Example
+    -------
+    >>> base = Scope(root='logs')
+    >>> a = base.fork(log_id='a')
+    >>> base['log_id'] = 'b'
+    >>> a['log_id'], a['root'], base['log_id']
+    ('a', 'logs', 'b')
+    '''
+    MAX_DEPTH = 8  # squash the layers if they get deeper than this
+    def __init__(self, data=None, layers=(), **kw):
+        self.local = dict(data or (), **kw)
+        self.layers = layers
+        self._flat = None
+        self.version = next(_VERSION)
+
+    def __repr__(self):
+        return repr(self.flat)
+
+    def __getitem__(self, key):
+        if key in self.local:
+            return self.local[key]
+        for layer in self.layers:
+            if key in layer:
+                return layer[key]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.flat
+
+    def __iter__(self):
+        return iter(self.flat)
 
-    def globs(self, *names):
-        return [f for name in names for f in self[name].glob()]
+    def __len__(self):
+        return len(self.flat)
 
+    def __setitem__(self, key, value):
+        self.local[key] = value
+        self._changed()
 
-class Path(os.PathLike):
+    def __delitem__(self, key):
+        if key not in self.flat:
+            raise KeyError(key)
+        if self.layers:  # the key may be in a shared layer - collapse to a local copy
+            self.local, self.layers = dict(self.flat), ()
+        del self.local[key]
+        self._changed()
+
+    def update(self, *a, **kw):
+        self.local.update(*a, **kw)
+        self._changed()
+
+    @property
+    def flat(self):
+        '''All layers merged into one dict (cached until the next change). Don't modify it.'''
+        if self._flat is None:
+            flat = {}
+            for layer in reversed(self.layers):
+                flat.update(layer)
+            flat.update(self.local)
+            self._flat = flat
+        return self._flat
+
+    def fork(self, data=None, **kw):
+        '''Create a new scope on top of this one. Neither scope will write to
+        the layers they share.'''
+        if self.local:
+            self.layers, self.local = (self.local,) + self.layers, {}
+        if len(self.layers) > self.MAX_DEPTH:
+            self.layers = (dict(self.flat),)
+        return Scope(data, self.layers, **kw)
+
+    def _changed(self):
+        self._flat = None
+        self.version = next(_VERSION)
+
+
+class PathMap(MutableMapping):
+    '''The name -> Path mapping for a Paths collection.
+
+    Copies share a read-only ``source`` of path definitions ``(pattern, data)``
+    and only create Path objects when they're accessed, so copying a
+    collection doesn't rebuild every path. Paths that were changed in place
+    (using ``Path.update``) are passed on to copies in a separate ``overlay``
+    of definitions, which is also shared until it changes.
+    '''
+    def __init__(self, paths=None):
+        self.owner = None
+        self.bound = dict(paths or {})
+        self.source = {name: _path_def(p) for name, p in self.bound.items()}
+        self.overlay = {}  # name -> (pattern, data) of paths changed in place
+        self.modified = set()
+        self._names = None  # id(path) -> name, built on first touch()
+        self._tree = self._with_data = None
+        self._shared = self._overlay_shared = False
+
+    @classmethod
+    def from_source(cls, source):
+        '''Create from path definitions ``{name: (pattern, data)}`` without building any paths.'''
+        m = cls()
+        m.source = source
+        return m
+
+    def bind(self, owner):
+        '''Attach to a Paths object.'''
+        self.owner = owner
+        for path in self.bound.values():
+            path.parent = owner
+
+    def copy(self):
+        '''Create a copy which shares the path definitions.'''
+        for name in self.modified:  # carry over the current data of paths changed in place
+            d = _path_def(self.bound[name])
+            if self.overlay.get(name) != d:
+                self._own_overlay()[name] = d
+        m = PathMap()
+        m.source, m._tree, m._with_data = self.source, self._tree, self._with_data
+        m.overlay = self.overlay
+        m._shared = self._shared = m._overlay_shared = self._overlay_shared = True
+        return m
+
+    def _own_overlay(self):
+        if self._overlay_shared:
+            self.overlay, self._overlay_shared = dict(self.overlay), False
+        return self.overlay
+
+    def tree(self):
+        '''Get the path definitions as a (cached) ``SegmentTree``.'''
+        if self._tree is None:
+            self._tree = SegmentTree((name, pattern) for name, (pattern, _) in self.source.items())
+        return self._tree if self._tree.compiled else None
+
+    def with_data(self):
+        '''Get the names of paths that have their own data.'''
+        if self._with_data is None:
+            self._with_data = {name for name, (_, data) in self.source.items() if data}
+        return self._with_data | self.modified | self.overlay.keys()
+
+    def touch(self, path):
+        '''Mark a path as modified in place. Returns False if it isn't in this mapping.'''
+        if self._names is None:
+            self._names = {id(p): name for name, p in self.bound.items()}
+        name = self._names.get(id(path))
+        if name is None or self.bound.get(name) is not path:
+            return False
+        self.modified.add(name)
+        return True
+
+    def __getitem__(self, name):
+        p = self.bound.get(name)
+        if p is None:
+            pattern, data = self.overlay.get(name) or self.source[name]
+            p = self.bound[name] = Path._make(pattern, _copy_data(data), self.owner)
+            if self._names is not None:
+                self._names[id(p)] = name
+        return p
+
+    def __setitem__(self, name, path):
+        if self._shared:
+            self.source, self._shared = dict(self.source), False
+        self.source[name] = _path_def(path)
+        if name in self.overlay:
+            del self._own_overlay()[name]
+        self.bound[name] = path
+        self._tree = self._with_data = None
+        if self._names is not None:
+            self._names[id(path)] = name
+        self.modified.discard(name)
+        if self.owner is not None:
+            self.owner._changed()
+
+    def __delitem__(self, name):
+        if self._shared:
+            self.source, self._shared = dict(self.source), False
+        del self.source[name]
+        if name in self.overlay:
+            del self._own_overlay()[name]
+        self.bound.pop(name, None)
+        self._tree = self._with_data = None
+        self.modified.discard(name)
+        if self.owner is not None:
+            self.owner._changed()
+
+    def __contains__(self, name):
+        return name in self.source
+
+    def __iter__(self):
+        return iter(self.source)
+
+    def __len__(self):
+        return len(self.source)
+
+
+def _path_def(path):
+    return path.path_pattern, _copy_data(path.data)
+
+
+_VERSION = itertools.count()
+
+
+class _EmptyData(dict):
+    '''The (read-only) data for paths that don't have any of their own.'''
+    __slots__ = ()
+    def _readonly(self, *a, **kw):
+        raise TypeError('Empty path data is shared and read-only. Use Path.update(...).')
+    __setitem__ = __delitem__ = update = setdefault = popitem = clear = _readonly
+
+    def pop(self, key, *default):
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+EMPTY = _EmptyData()
+
+def _copy_data(data):
+    return dict(data) if data else EMPTY
+
+
+def _join_pattern(*parts):
+    '''Join and normalize path parts the way pathlib does (interned so copies share it).'''
+    if os.sep != '/':
+        import pathlib
+        return sys.intern(str(pathlib.PurePath(*parts)))
+    root, names = '', []
+    for part in map(os.fspath, parts):
+        if part.startswith('/'):  # an absolute part replaces everything before it
+            root = '//' if part[:2] == '//' and part[:3] != '///' else '/'
+            names = []
+        names.extend(x for x in part.split('/') if x and x != '.')
+    return sys.intern(root + '/'.join(names) or '.')
+
+
+class Path(object):
     '''
     # define a path with missing parts
     path = Paths('blah/{something}/{huh}/what')
@@ -219,11 +957,20 @@ class Path(os.PathLike):
     assert isinstance(path.matching)
     '''
     __FORBIDDEN_KEYS__ = ()
+    __slots__ = ('_pattern', '_template', 'data', 'parent')
     def __init__(self, *path, data=None, parent=None):
-        self._path = pathlib.Path(*path)
-        self.data = {} if data is None else data
+        self._pattern = _join_pattern(*path)
+        self._template = None
+        self.data = data or EMPTY
         self.parent = parent
 
+    @classmethod
+    def _make(cls, pattern, data, parent):
+        '''Create a path from an already normalized pattern.'''
+        p = cls.__new__(cls)
+        p._pattern, p._template, p.data, p.parent = pattern, None, data or EMPTY, parent
+        return p
+
     def __str__(self):
         '''The path as a string (partially formatted)'''
         return self.partial_format()
@@ -261,11 +1008,18 @@ class Path(os.PathLike):
     @property
     def path_pattern(self):
         '''The path as an unformatted string'''
-        return str(self._path)
+        return self._pattern
+
+    @property
+    def _path(self):
+        '''The unformatted path as a pathlib.Path object'''
+        import pathlib
+        return pathlib.Path(self._pattern)
 
     @property
     def path(self):
         '''Get the formatted path as a pathlib.Path object'''
+        import pathlib
         return pathlib.Path(self.format())
 
     @property
@@ -288,16 +1042,21 @@ class Path(os.PathLike):
     @property
     def path_data(self):
         '''Both the path specific data and the paths group data'''
-        return {**self.parent.data, **self.data} if self.parent else self.data
+        return {**self.parent.data.flat, **self.data} if self.parent else self.data
 
     def update(self, **kw):
         '''Update specified data in place'''
+        if self.data is EMPTY:
+            self.data = {}
         self.data.update(**{k: v for k, v in kw.items() if k not in self.__FORBIDDEN_KEYS__})
+        if self.parent is not None:
+            self.parent._changed(self)
         return self
 
     def specify(self, **kw):
         '''Update specified data and return a new object'''
-        return self.copy.update(**kw)
+        kw = {k: v for k, v in kw.items() if k not in self.__FORBIDDEN_KEYS__}
+        return Path._make(self._pattern, {**self.data, **kw} if kw else _copy_data(self.data), self.parent)
 
     def unspecify(self, *keys, parent=True):
         '''Remove keys from path dictionary'''
@@ -312,16 +1071,23 @@ class Path(os.PathLike):
     @property
     def fully_specified(self):
         '''Check if the path is fully specified.'''
-        try:
-            self.format()
-            return True
-        except KeyError:
-            return False
+        if not self.template.compiled:
+            try:
+                self.format()
+                return True
+            except KeyError:
+                return False
+        return not self.missing_fields()
+
+    def missing_fields(self, **kw):
+        '''Get the set of fields in the pattern that don't have any data.'''
+        maps = self._maps(kw)
+        return {f for f in self.template.fields if not any(f in m for m in maps)}
 
     @property
     def unspecified(self):
         '''Get a path without any attached data.'''
-        return Path(self._path)
+        return Path._make(self._pattern, None, None)
 
     '''
 
@@ -332,30 +1098,32 @@ class Path(os.PathLike):
     @property
     def safe(self):
         '''Make sure the path does not go above root.'''
-        return self.repath(os.path.normpath(os.sep + str(self._path)).lstrip(os.sep))
+        return self.repath(os.path.normpath(os.sep + self._pattern).lstrip(os.sep))
 
     def repath(self, *f, data=None):
         '''Make a copy with an entirely new path.'''
-        return Path(*f, data=dict(self.data, **(data or {})), parent=self.parent)
+        return Path(*f, data=dict(self.data, **data) if data else _copy_data(self.data),
+                    parent=self.parent)
 
     def join(self, *f):
         '''Make a copy and append directories to the end.'''
-        return self.repath(self._path, *f)
+        return self.repath(self._pattern, *f)
 
     def assign_name(self, name):
         '''Assign a new name to '''
         if self.parent:
             self.parent.paths[name] = self
+            self.parent._changed()
 
     @property
     def copy(self):
         '''Create a copy of the path object.'''
-        return self.join()
+        return Path._make(self._pattern, _copy_data(self.data), self.parent)
 
     def up(self, n=1):
         '''Create a copy of the path object up one directory.'''
         return self.repath(
-            os.path.normpath(os.path.join(self._path, *(['..']*n))))
+            os.path.normpath(os.path.join(self._pattern, *(['..']*n))))
 
     def find_sibling(self, name):
         '''Find another path in the root tree.'''
@@ -374,22 +1142,43 @@ class Path(os.PathLike):
     '''
 
     def exists(self):
-        return self.path.exists()
+        cache = StatCache.active()
+        return cache.kind(self.format()) is not None if cache else os.path.exists(self.format())
 
     def is_file(self):
-        return self.path.is_file()
+        cache = StatCache.active()
+        return cache.kind(self.format()) == 'file' if cache else os.path.isfile(self.format())
 
     def is_dir(self):
-        return self.path.is_dir()
-
-    def read_text(self, *a, **kw):
-        return self.path.read_text(*a, **kw)
-
-    def write_text(self, *a, **kw):
-        return self.path.write_text(*a, **kw)
-
-    def rmdir(self, *a, **kw):
-        return self.path.rmdir(*a, **kw)
+        cache = StatCache.active()
+        return cache.kind(self.format()) == 'dir' if cache else os.path.isdir(self.format())
+
+    def read_text(self, encoding=None, errors=None):
+        with _open(self.format(), encoding=encoding, errors=errors) as fh:
+            return fh.read()
+
+    def write_text(self, data, encoding=None, errors=None):
+        if not isinstance(data, str):
+            raise TypeError('data must be str, not {}'.format(type(data).__name__))
+        _invalidate(self)
+        with _open(self.format(), 'w', encoding=encoding, errors=errors) as fh:
+            return fh.write(data)
+
+    def read_bytes(self):
+        with _open(self.format(), 'rb') as fh:
+            return fh.read()
+
+    def write_bytes(self, data):
+        view = memoryview(data)
+        _invalidate(self)
+        with _open(self.format(), 'wb') as fh:
+            return fh.write(view)
+
+    def rmdir(self):
+        f = self.format()
+        _invalidate(self, recursive=True)
+        os.rmdir(f)
+        forget_dirs(f)
 
 
     '''
@@ -398,6 +1187,20 @@ class Path(os.PathLike):
 
     '''
 
+    @property
+    def template(self):
+        '''The compiled (and cached) format template for this path pattern.'''
+        if self._template is None:
+            self._template = compile_pattern(self.path_pattern)
+        return self._template
+
+    def _maps(self, kw=None):
+        '''The data layers used for formatting, in lookup order.'''
+        if self.parent is None:
+            return (kw, self.data) if kw else (self.data,)
+        data = self.parent.data.flat
+        return (kw, self.data, data) if kw else (self.data, data)
+
     def format(self, **kw):
         '''Insert data into the path string. (Works like string format.)
 
@@ -405,7 +1208,7 @@ class Path(os.PathLike):
             KeyError if the format string is underspecified.
         '''
         try:
-            return self.path_pattern.format(**{**self.path_data, **kw})
+            return self.template.format(self._maps(kw))
         except KeyError as e:
             raise UnderspecifiedError(str(e))
 
@@ -414,36 +1217,48 @@ class Path(os.PathLike):
         pattern = self.partial_format() if use_data else self.path_pattern
         data = parse(pattern, path)
         if not data:
-            raise ValueError(inspect.cleandoc('''
-                Could not parse path using pattern.
-                    path:{}
-                    pattern:{}
-
-                `path.parse(path)` will call self.partial_format() by default before parsing
-                so any specified keys will be fixed. This is helpful to dodge ambiguous parsing
-                cases. To disable this pass `use_data=False` to parse.
-                '''.format(path, pattern)))
+            raise _parse_error(path, pattern)
         return {**self.path_data, **data}
 
+    def parse_many(self, paths, use_data=True, columns=False, errors='raise'):
+        '''Parse many paths using the same (compiled once) pattern.
+
+        Arguments:
+            paths (iterable): the strings to parse.
+            use_data (bool): fill specified keys before parsing. See ``parse``.
+            columns (bool): return a dict of lists (with the input paths under
+                ``'path'``) instead of a generator of ``(path, data)``.
+            errors (str): what to do with paths that don't match. ``'raise'``
+                raises a ValueError, ``'skip'`` leaves them out.
+        '''
+        pattern = self.partial_format() if use_data else self.path_pattern
+        it = _parse_many(compile_parser(pattern), pattern, paths, self.path_data, errors)
+        if not columns:
+            return it
+        cols = {'path': []}
+        for i, (path, data) in enumerate(it):
+            cols['path'].append(path)
+            for k, v in data.items():
+                cols.setdefault(k, [None]*i).append(v)
+        return cols
+
     def translate(self, path, to, **kw):
         '''Translate the paths to another pattern'''
         return self.find_sibling(to).specify(**self.parse(path, **kw))
 
     def maybe_format(self, **kw):
         '''Try to format a field. If it fails, return as a Path object.'''
-        p = self.specify(**kw)
         try:
-            return p.format()
+            return self.template.format(self._maps(kw))
         except KeyError:
-            return p
+            return self.specify(**kw)
 
     def partial_format(self, **kw):
         '''Format a field, leaving all unspecified fields to be filled later.'''
-        f = pformat(self.path_pattern, **{**self.path_data, **kw})
-        return f
+        return self.template.partial_format(self._maps(kw))
 
     def format_only(self, **kw):
-        return pformat(self.path_pattern, **kw)
+        return self.template.partial_format((kw,))
 
     '''
 
@@ -454,35 +1269,133 @@ class Path(os.PathLike):
     @property
     def glob_pattern(self):
         '''Format a field, setting all unspecified fields as a wildcard (asterisk).'''
-        return gformat(self.path_pattern, **self.path_data)
+        return self.template.glob_format(self._maps())
 
-    def glob(self, *f):
-        '''Find all matching files. unspecified fields are set as a wildcard (asterisk).'''
+    def glob(self, *f, **constraints):
+        '''Find all matching files. unspecified fields are set as a wildcard (asterisk).
+
+        Fields can be constrained to a set of values (``date={'a', 'b'}``),
+        a range (``i_epoch=range(100, 200)``), or a predicate
+        (``name=lambda x: x.startswith('a')``). See ``Path.scan``.
+        '''
+        if constraints:
+            return sorted(file for file, _ in self.scan(*f, sort=False, **constraints))
         return sglob(self.glob_pattern, *f)
 
-    def iglob(self, *f):
+    def iglob(self, *f, **constraints):
         '''Find all matching files as a generator.'''
+        if constraints:
+            return (file for file, _ in self.scan(*f, **constraints))
+        import glob
         return glob.iglob(os.path.join(self.glob_pattern, *f))
 
     def rglob(self, *f, include=None):
         '''Find all matching files recursively as a generator.'''
         # if the path isn't an existing dir, assume it's a glob pattern
         include = not self.is_dir() if include is None else include
-        fs = self.path.rglob(os.path.join(*(f or '*')))
+        import pathlib
+        fs = (pathlib.Path(f) for f in _rglob(self.format(), os.path.join(*(f or '*'))))
         return itertools.chain((
             pathlib.Path(f) for f in self.glob()), fs) if include else fs
 
-    def next_unique(self, i=1, suffix='_{:02}'):
+    def scan(self, *f, sort=True, **constraints):
+        '''Find all matching files and parse them in a single pass.
+
+        Walks the pattern one directory level at a time with ``os.scandir``,
+        only descending into entries that match that level's fields (using
+        their format spec, e.g. ``{i_epoch:04d}`` only matches digits).
+        Each field matches a single path component.
+
+        Fields can be constrained:
+         - a single value (str/number) is the same as ``specify``
+         - a set/list/tuple/range of values: if the number of combinations is
+           at most ``MAX_PROBES``, each combination is formatted and checked
+           directly (no directory listing), otherwise entries are filtered
+           while walking.
+         - a predicate ``f(value) -> bool`` filters entries while walking.
+
+        Constraining a field the pattern doesn't have raises a KeyError.
+        Extra path components (``*f``) are globbed below each match.
+
+        Yields:
+            path (str): the matching file.
+            data (dict): the path data plus the fields parsed from the file.
+        '''
+        if f:
+            import glob
+            return (
+                (file, data) for path, data in self.scan(sort=sort, **constraints)
+                for file in (sorted if sort else list)(glob.glob(os.path.join(glob.escape(path), *f))))
+
+        unknown = set(constraints) - compile_pattern(self.path_pattern).fields
+        if unknown:
+            raise KeyError('Unknown fields {} for path {}'.format(', '.join(sorted(unknown)), self.path_pattern))
+        for k, v in constraints.items():
+            if not isinstance(v, (str, bytes, int, float, Collection)) and not callable(v):
+                raise TypeError(
+                    'Constraint {}={!r} should be a value, a collection of values (set, '
+                    'list, range, ...) or a predicate.'.format(k, v))
+
+        fixed = {k: v for k, v in constraints.items() if isinstance(v, (str, bytes, int, float))}
+        p = self.specify(**fixed) if fixed else self
+        pattern = p.partial_format()
+        fields = compile_pattern(pattern).fields
+        filters = {k: _as_filter(v) for k, v in constraints.items() if k not in fixed}
+        # fields that are already specified are checked against their value
+        data = p.path_data
+        if any(k not in fields and k in data and not filters[k](data[k]) for k in filters):
+            return iter([])
+        constraints = {k: v for k, v in constraints.items() if k in filters and k in fields}
+        filters = {k: filters[k] for k in constraints}
+
+        values = {k: v for k, v in constraints.items() if not callable(v)}
+        n_probes = 1
+        for v in values.values():
+            n_probes *= len(v)
+        probes = (_probe(pattern, p.path_data, values, filters, sort)
+                  if values and n_probes <= MAX_PROBES else None)
+        if probes is not None:
+            return probes
+        return scan(pattern, p.path_data, sort=sort, filters=filters)
+
+    walk = scan
+
+    def listing(self, name=None):
+        '''List the matching files, remembering the directories so that
+        ``listing.refresh()`` only lists directories that changed. See ``Listing``.'''
+        listing = Listing(self.partial_format(), self.path_data, name)
+        listing.scan()
+        return listing
+
+    def next_unique(self, i=1, suffix='_{:02}', scan=False):
         '''Get the next filename that doesn't exist.
         e.g. Path('results/')
+
+        By default, this checks ``f``, ``f_01``, ``f_02``, ... until one is free.
+        With ``scan=True``, the directory is listed once and the index after
+        the largest existing one is used. The index is then remembered for
+        the rest of the process so later calls don't list the directory again
+        (each name is only handed out once - see ``pathtree.path.forget_unique()``).
         '''
         f = self.format()
+        if scan:
+            return _next_unique(f, suffix, i)[0]
         f_pattern = '{}{{}}{}'.format(*os.path.splitext(f))
         sfx = suffix if callable(suffix) else suffix.format
         while os.path.exists(f):
             f, i = f_pattern.format(sfx(i)), i + 1
         return f
 
+    def next_unique_many(self, k, i=1, suffix='_{:02}', create=False):
+        '''Reserve ``k`` unused filenames at once (see ``next_unique(scan=True)``).
+
+        Set ``create=True`` to create each file exclusively (``O_EXCL``) so
+        that processes writing to the same directory never get the same name.
+        '''
+        if create:
+            self.make(1)
+        return _next_unique(self.format(), suffix, i, k, create=create)
+
     def prefix(self, prefix='{prefix}_'):
         return self.up().join('{}{}'.format(
             prefix, os.path.basename(self.path_pattern)))
@@ -499,52 +1412,1423 @@ class Path(os.PathLike):
 
     def make(self, up=0):
         '''Create this (or up a) directory.'''
-        os.makedirs(self.up(up), exist_ok=True)
+        f = self.up(up).format()
+        os.makedirs(f, exist_ok=True)
+        d = os.path.abspath(f)
+        _known_dirs.update(_ancestors(d), (d,))
+        _invalidate(f)
         return self
 
     def touch(self, *a, **kw):
         '''Touch this file - will recursively create parent directories.'''
-        self.make(up=1).path.touch(*a, **kw)
+        _touch(self.make(up=1).format(), *a, **kw)
+        _invalidate(self)
         return self
 
     def rm(self):
         '''Remove this file or directory.'''
         p = self.safe
-        p.rmdir() if self.is_dir() else os.remove(p.format()) if self.is_file() else None
+        if self.is_dir():
+            p.rmdir()
+        elif self.is_file():
+            os.remove(p.format())
+            _invalidate(p)
         return self
 
-    def rmglob(self, *f, include=None):
+    def rmglob(self, *f, include=None, workers=None):
         '''Recursively remove files matching join(*f). Set include=True, to
         remove this node as well.'''
+        if not f and self.safe.is_dir():  # everything - no need to match
+            self.rmtree(include=bool(include), workers=workers)
+            return self
         fs = list(sorted(self.safe.rglob(*f, include=include), key=lambda p: p.parts, reverse=True))
         for fi in fs:
             fi.rmdir() if fi.is_dir() else os.remove(fi)
+        forget_dirs(self.safe.glob_pattern, glob=True)
+        _invalidate(self.safe.glob_pattern, recursive=True, glob=True)
         return self
 
+    def rmtree(self, include=True, workers=None, dry_run=False):
+        '''Remove this directory and everything in it, bottom-up.
+
+        Each directory is listed once with ``os.scandir`` (relative to an
+        open directory fd where supported) and its entries are removed
+        without being stat'ed again. Symlinks are removed, not followed.
+
+        Arguments:
+            include (bool): remove this directory as well as its contents.
+            workers (int): unlink the files in each directory using a thread pool.
+            dry_run (bool): don't remove anything, just count it (and the bytes).
+
+        Returns:
+            dict: the number of ``files`` and ``dirs`` removed (and ``bytes`` if dry_run).
+        '''
+        f = self.safe.format()
+        counts = _rmtree(f, include=include, workers=workers, dry_run=dry_run)
+        if not dry_run:
+            forget_dirs(f)
+            _invalidate(f, recursive=True)
+        return counts
+
     def write(self, x, mode='', **kw):
         '''Write to file. Set mode='b' to write as bytes.'''
         self.make(1)
         b = 'b' in mode if mode else isinstance(x, (bytes, bytearray))
         self.write_bytes(x, **kw) if b else self.write_text(str(x), **kw)
+        _invalidate(self)
         return self
 
     def read(self, mode='', **kw):
         '''Read file. Set mode='b' to read as bytes.'''
         return self.read_bytes(**kw) if 'b' in mode else self.read_text(**kw)
 
+    def mmap(self, mode='r'):
+        '''Memory-map the file instead of reading it into memory.
+
+        .. code-block:: python
+
+            with path.mmap() as m:
+                x = np.frombuffer(m, dtype='int16')
+
+        Arguments:
+            mode (str): 'r' for read only, 'r+' to write changes back to
+                the file, 'c' for copy-on-write (changes stay in memory).
+
+        Returns a context manager for an ``mmap.mmap`` (or an empty
+        ``memoryview`` for empty files).
+        '''
+        return _mmap(self.format(), mode)
+
+    def read_into(self, buffer, offset=0):
+        '''Read the file into an existing buffer (e.g. a bytearray or numpy
+        array), starting ``offset`` bytes into the file. Returns the number
+        of bytes read.'''
+        return _read_into(self.format(), buffer, offset)
+
+    @contextlib.contextmanager
+    def mmap_glob(self, *f, mode='r', **constraints):
+        '''Memory-map all matching files. Yields ``{file: mmap}``.
+        See ``Path.glob`` for ``constraints``.'''
+        with contextlib.ExitStack() as stack:
+            yield {fi: stack.enter_context(_mmap(fi, mode))
+                   for fi in self.glob(*f, **constraints)}
+
+    def write_many(self, items, mode='', workers=8, **kw):
+        '''Write many files at once, creating each parent directory once.
+
+        .. code-block:: python
+
+            paths.plot.write_many(({'plot_name': k}, v) for k, v in plots.items())
+
+        Arguments:
+            items (iterable): ``(data, content)`` pairs. The data is used to format the path.
+            mode (str): set mode='b' to write as bytes (the default is to check the content's type).
+            workers (int): the number of threads to write with.
+
+        Returns:
+            list: the files that were written.
+        '''
+        items = [(self.format(**data), x) for data, x in items]
+        # not skipping dirs seen before - they may have been removed since
+        makedirs({os.path.dirname(f) or '.' for f, _ in items}, cache=False)
+        _map(lambda fx: _write_file(fx[0], fx[1], mode, **kw), items, workers)
+        return [f for f, _ in items]
+
+    def read_many(self, items, mode='', workers=8, ordered=True, **kw):
+        '''Read many files at once using a thread pool.
+
+        .. code-block:: python
+
+            for data, text in paths.result_step.read_many({'step_name': s} for s in steps):
+                ...
+
+        Arguments:
+            items (iterable): dicts of data used to format the path.
+            mode (str): set mode='b' to read as bytes.
+            workers (int): the number of threads to read with.
+            ordered (bool): yield in the same order as ``items``. Otherwise, yield
+                each file as soon as it's read.
+
+        Yields:
+            ``(data, content)`` for each item.
+        '''
+        items = [(data, self.format(**data)) for data in items]
+        read = lambda f: _read_file(f, mode, **kw)
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+        with ThreadPoolExecutor(workers) as pool:
+            if ordered:
+                yield from zip((d for d, _ in items), pool.map(read, [f for _, f in items]))
+            else:
+                futs = {pool.submit(read, f): data for data, f in items}
+                for fut in as_completed(futs):
+                    yield futs[fut], fut.result()
+
     def open(self, mode='r', *a, makedir=True, **kw):
         if makedir and any(m in mode for m in ('wa' if makedir is True else makedir)):
             self.up().make()
-        return self.path.open(mode, *a, **kw)
+        if any(m in mode for m in 'wax+'):
+            _invalidate(self)
+        return _open(self.format(), mode, *a, **kw)
 
     def move(self, f_new):
         '''Move the file to a new name.'''
-        os.rename(self.format(), f_new)
+        f = self.format()
+        os.rename(f, f_new)
+        forget_dirs(f)
+        _invalidate(self, recursive=True)
+        _invalidate(f_new, recursive=True)
         return self.repath(f_new)
 
+    '''
+
+    Async
+
+    These run the blocking calls on a shared, bounded thread pool
+    (see ``pathtree.path.set_async_workers``).
+
+    '''
+
+    async def aread(self, mode='', **kw):
+        return await _run_async(self.read, mode, **kw)
+
+    async def awrite(self, x, mode='', **kw):
+        await _run_async(self.write, x, mode, **kw)
+        return self
+
+    async def atouch(self, *a, **kw):
+        await _run_async(self.touch, *a, **kw)
+        return self
+
+    async def aexists(self):
+        return await _run_async(self.exists)
+
+    async def ais_file(self):
+        return await _run_async(self.is_file)
+
+    async def ais_dir(self):
+        return await _run_async(self.is_dir)
+
+    def aglob(self, *f, **constraints):
+        '''Find all matching files (sorted) as an async iterator.
+
+        .. code-block:: python
+
+            async for f in path.aglob():
+                ...
+        '''
+        return _aiterate(lambda: iter(self.glob(*f, **constraints)))
+
+    def aiglob(self, *f, **constraints):
+        '''Find all matching files as an async iterator, as they're found.'''
+        return _aiterate(lambda: self.iglob(*f, **constraints))
+
+    def arglob(self, *f, include=None):
+        '''Find all matching files recursively as an async iterator.'''
+        return _aiterate(lambda: self.rglob(*f, include=include))
+
+
+os.PathLike.register(Path)
+
+
+def _parse_error(path, pattern):
+    import inspect
+    return ValueError(inspect.cleandoc('''
+        Could not parse path using pattern.
+            path:{}
+            pattern:{}
+
+        `path.parse(path)` will call self.partial_format() by default before parsing
+        so any specified keys will be fixed. This is helpful to dodge ambiguous parsing
+        cases. To disable this pass `use_data=False` to parse.
+        '''.format(path, pattern)))
+
+def _parse_many(parser, pattern, paths, data, errors='raise'):
+    '''Parse each path with a compiled parser, yielding (path, data).'''
+    if errors not in ('raise', 'skip'):
+        raise ValueError("errors must be 'raise' or 'skip', got {!r}".format(errors))
+    for path in paths:
+        r = parser.parse(os.fspath(path))
+        if r is None:
+            if errors == 'raise':
+                raise _parse_error(path, pattern)
+            continue
+        yield path, {**data, **r.named}
+
+
+def scan(pattern, data=None, sort=True, filters=None, listing=None):
+    '''Find files matching a format pattern, yielding ``(path, parsed_data)``.
+    See ``Path.scan``. Directories are listed through ``listing`` if given
+    (see ``Listing``).'''
+    if os.altsep:
+        pattern = pattern.replace(os.altsep, os.sep)
+    base = os.sep if pattern.startswith(os.sep) else ''
+    parts = _split_pattern(pattern)
+    if parts is None:  # a field spans directories - parse everything below the literal prefix
+        return _scan_tree(pattern, dict(data or {}), sort, filters or {})
+
+    # join literal components so we only list directories with fields in them
+    segments = []
+    for part in parts:
+        if not part:
+            continue
+        t = compile_pattern(part)
+        if t.literal is None:
+            segments.append((part, compile_parser(part, case_sensitive=True)))
+        elif segments and isinstance(segments[-1], str):
+            segments[-1] = os.path.join(segments[-1], t.literal)
+        else:
+            segments.append(t.literal)
+    if not segments:
+        return iter([(base or '.', dict(data or {}))])
+    return _scan(base, segments, dict(data or {}), sort, filters or {}, listing)
+
+def _scan(base, segments, data, sort, filters, listing=None):
+    seg, rest = segments[0], segments[1:]
+    if isinstance(seg, str):
+        path = os.path.join(base, seg) if base else seg
+        if rest:
+            yield from _scan(path, rest, data, sort, filters, listing)
+        elif _lexists(path):
+            yield path, data
+        return
+
+    if listing is not None:
+        known = listing.known(base) if not rest else None
+        if known is not None:  # an unchanged directory of files
+            yield from known
+            return
+        entries = listing.entries(base or '.', sort)
+        if entries is None:
+            return
+    else:
+        cache = StatCache.active()
+        try:
+            if cache:
+                entries = cache.scandir(base or '.')
+            else:
+                with os.scandir(base or '.') as it:
+                    entries = list(it)
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            if cache:
+                cache.forget(base or '.')
+            return
+        if sort:
+            entries = sorted(entries, key=lambda e: e.name)
+
+    part, parser = seg
+    for entry in entries:
+        if entry.name.startswith('.') and not part.startswith('.'):
+            continue  # like glob, don't match hidden files with a wildcard
+        r = parser.parse(entry.name)
+        if r is None or any(
+                data.get(k, v) != v or k in filters and not filters[k](v)
+                for k, v in r.named.items()):
+            continue
+        path = os.path.join(base, entry.name) if base else entry.name
+        if rest:
+            if entry.is_dir():
+                yield from _scan(path, rest, {**data, **r.named}, sort, filters, listing)
+        else:
+            yield path, {**data, **r.named}
+
+
+def _scan_tree(pattern, data, sort, filters):
+    parser = compile_parser(pattern, case_sensitive=True)
+    prefix = compile_pattern(pattern).segments[0][0]
+    top = os.path.dirname(prefix) if os.sep in prefix else ''
+    # like glob, don't match hidden files with a wildcard
+    hidden = pattern.startswith('.') or os.sep + '.' in pattern
+    found = []
+    for d, dirs, files in os.walk(top or '.'):
+        if not hidden:
+            dirs[:] = [x for x in dirs if not x.startswith('.')]
+        for name in itertools.chain(dirs, files):
+            if not hidden and name.startswith('.'):
+                continue
+            path = os.path.join(d, name) if top else os.path.relpath(os.path.join(d, name))
+            r = parser.parse(path)
+            if r is None or any(
+                    data.get(k, v) != v or k in filters and not filters[k](v)
+                    for k, v in r.named.items()):
+                continue
+            found.append((path, {**data, **r.named}))
+    return iter(sorted(found) if sort else found)
+
+def _probe(pattern, data, values, filters, sort=True):
+    '''Check each combination of constrained values directly instead of listing.
+    Returns None if the values can't be formatted into the pattern.'''
+    keys = list(values)
+    t = compile_pattern(pattern)
+    try:
+        patterns = [(t.partial_format((d,)), d) for d in (
+            dict(zip(keys, combo)) for combo in itertools.product(*(
+                sorted(values[k], key=str) if sort else values[k] for k in keys)))]
+    except (ValueError, TypeError):  # e.g. '5' for {i_epoch:04d}
+        return None
+    return (
+        r for p, d in patterns
+        for r in scan(p, {**data, **d}, sort=sort, filters=filters))
+
+def _as_filter(constraint):
+    '''Convert a field constraint (predicate, range, or collection) to a predicate.'''
+    if callable(constraint):
+        return constraint
+    if isinstance(constraint, range):
+        def check(v):
+            try:
+                return int(v) in constraint
+            except (TypeError, ValueError):
+                return False
+        return check
+    values = set(constraint)
+    strs = {str(v) for v in values}
+    return lambda v: v in values or str(v) in strs
+
+
+class Listing(object):
+    '''The files matching a pattern, remembering each directory it listed
+    (its mtime, entry count and entries) so that ``refresh`` only lists the
+    directories whose mtime changed again.
+
+    .. code-block:: python
+
+        listing = paths.flac.listing()
+        listing.files  # {file: data}
+        ...
+        listing.refresh()  # {'added': [(name, file, data)], 'removed': [...]}
+
+    Only added and removed files are detected (not changes to a file's contents).
+
+    Arguments:
+        pattern (str): the (partially formatted) path pattern.
+        data (dict): the path data.
+        name (str): the path name to use in the events.
+        dirs (dict): directories from a previous listing.
+        files (dict): files from a previous listing.
+    '''
+    # directories changed this close to (or after) when they were last listed
+    # are listed again, in case they changed within the mtime resolution.
+    RACY = 2.
+
+    def __init__(self, pattern, data=None, name=None, dirs=None, files=None):
+        self.pattern, self.data, self.name = pattern, dict(data or {}), name
+        # dir -> (mtime_ns, entry count, listed at (ns), entry names, subdirectory names)
+        self.dirs = dirs if dirs is not None else {}
+        self.files = files if files is not None else {}
+        self._seen = self._mtimes = self._by_dir = None
+
+    def __repr__(self):
+        return '<Listing "{}" files={} dirs={}>'.format(self.pattern, len(self.files), len(self.dirs))
+
+    def scan(self):
+        '''List every directory again. Returns the files as ``{file: data}``.'''
+        self.dirs.clear()
+        self.refresh()
+        return self.files
+
+    def refresh(self):
+        '''List the directories that changed since they were last listed.
+
+        Returns:
+            dict: ``{'added': [(name, file, data), ...], 'removed': [...]}``
+        '''
+        self._seen, self._mtimes, self._by_dir = set(), {}, {}
+        for f, data in self.files.items():
+            self._by_dir.setdefault(os.path.dirname(f), []).append((f, data))
+        try:
+            files = dict(scan(self.pattern, self.data, listing=self))
+        finally:
+            self._mtimes = self._by_dir = None
+        for d in set(self.dirs) - self._seen:
+            del self.dirs[d]  # gone or no longer matching
+        old, self.files = self.files, files
+        return {
+            'added': [(self.name, f, files[f]) for f in sorted(files.keys() - old.keys())],
+            'removed': [(self.name, f, old[f]) for f in sorted(old.keys() - files.keys())],
+        }
+
+    def known(self, d):
+        '''Get the files in a directory from the last listing if its mtime
+        hasn't changed (otherwise None).'''
+        if self._unchanged(d or '.'):
+            self._seen.add(d or '.')
+            return self._by_dir.get(d, [])
+
+    def entries(self, d, sort=True):
+        '''Get the entries of a directory - from the last listing if its mtime
+        hasn't changed. Returns None if it isn't a directory.'''
+        mtime = self._mtime(d)
+        if mtime is None:
+            return None
+        self._seen.add(d)
+        if self._unchanged(d):
+            rec = self.dirs[d]
+            subdirs = set(rec[4])
+            return [_Entry(name, name in subdirs) for name in rec[3]]
+
+        listed_at = int(time.time() * 1e9)
+        try:
+            with os.scandir(d) as it:
+                entries = sorted(it, key=lambda e: e.name) if sort else list(it)
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            return None
+        self.dirs[d] = (mtime, len(entries), listed_at, [e.name for e in entries],
+                        [e.name for e in entries if e.is_dir()])
+        return entries
+
+    def _unchanged(self, d):
+        rec = self.dirs.get(d)
+        mtime = self._mtime(d)
+        return rec is not None and rec[0] == mtime and mtime < rec[2] - self.RACY * 1e9
+
+    def _mtime(self, d):
+        if d not in self._mtimes:
+            try:
+                self._mtimes[d] = os.stat(d).st_mtime_ns
+            except (FileNotFoundError, NotADirectoryError, PermissionError):
+                self._mtimes[d] = None
+        return self._mtimes[d]
+
+class _Entry(object):
+    '''A remembered directory entry (the parts of ``os.DirEntry`` that ``scan`` uses).'''
+    __slots__ = ('name', '_dir')
+    def __init__(self, name, is_dir):
+        self.name, self._dir = name, is_dir
+
+    def is_dir(self):
+        return self._dir
+
+
+class FileIndex(object):
+    '''A SQLite table of matched files - one row per file with the path
+    name, each parsed field as a column, the size and mtime.
+
+    Use ``Paths.index`` to build one. Open an existing database with
+    ``FileIndex('files.db')``.
+
+    Arguments:
+        db (str): the database file (or ':memory:').
+    '''
+    COLUMNS = ('_path', '_name', '_size', '_mtime', '_data')
+
+    def __init__(self, db=':memory:'):
+        import sqlite3
+        self.db = db
+        self.conn = sqlite3.connect(db, check_same_thread=False)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS files (_path TEXT PRIMARY KEY, '
+            '_name TEXT, _size INTEGER, _mtime REAL, _data TEXT)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS files_name ON files (_name)')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS dirs (_name TEXT, _dir TEXT, mtime_ns INTEGER, '
+            'entries INTEGER, listed_at INTEGER, names TEXT, subdirs TEXT, PRIMARY KEY (_name, _dir))')
+        self.fields = {row[1] for row in self.conn.execute('PRAGMA table_info(files)')} - set(self.COLUMNS)
+
+    def __repr__(self):
+        return '<FileIndex {} files={}>'.format(self.db, self.count())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def add(self, name, files, fields=None, replace=True):
+        '''Add ``(file, data)`` pairs (e.g. from ``Path.scan``) under a path name.
+
+        Arguments:
+            name (str): the path name.
+            files (iterable): ``(file, data)`` pairs.
+            fields (set): the data keys to store as columns. Defaults to all of them.
+            replace (bool): remove the rows already indexed for this name.
+        '''
+        import json
+        groups = {}  # rows with the same columns are inserted together
+        for f, data in files:
+            data = {k: _sql_value(v) for k, v in data.items() if fields is None or k in fields}
+            try:
+                st = os.stat(f)
+            except FileNotFoundError:
+                continue
+            groups.setdefault(tuple(data), []).append(
+                (f, name, st.st_size, st.st_mtime, json.dumps(data)) + tuple(data.values()))
+        self._add_columns({k for keys in groups for k in keys})
+        with self.conn:
+            if replace:
+                self.conn.execute('DELETE FROM files WHERE _name = ?', (name,))
+            for keys, rows in groups.items():
+                cols = self.COLUMNS + keys
+                self.conn.executemany('INSERT OR REPLACE INTO files ({}) VALUES ({})'.format(
+                    ', '.join(map(_sql_name, cols)), ', '.join('?' * len(cols))), rows)
+        return self
+
+    def refresh(self, paths, *names):
+        '''Update the index from the directories whose mtime changed since
+        they were last listed (see ``Listing``).
+
+        Arguments:
+            paths (Paths): the paths the index was built from.
+            *names: the path names to refresh. Defaults to all indexed names.
+
+        Returns:
+            dict: ``{'added': [(name, file, data), ...], 'removed': [...]}``
+        '''
+        changes = {'added': [], 'removed': []}
+        for name in names or self.names():
+            p = paths[name]
+            # only the file names are needed to compare - the data is looked up for removed files
+            listing = Listing(p.partial_format(), p.path_data, name, self._load_dirs(name),
+                              dict.fromkeys(self.files(name)))
+            found = listing.refresh()
+            found['removed'] = [(name, f, self._data(f)) for _, f, _ in found['removed']]
+            with self.conn:
+                self.conn.executemany('DELETE FROM files WHERE _path = ?', ((f,) for _, f, _ in found['removed']))
+            self.add(name, ((f, data) for _, f, data in found['added']), p.template.fields, replace=False)
+            self._save_dirs(name, listing.dirs)
+            for k in changes:
+                changes[k].extend(found[k])
+        return changes
+
+    def _data(self, f):
+        import json
+        row = self.conn.execute('SELECT _data FROM files WHERE _path = ?', (f,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def names(self):
+        '''Get the indexed path names.'''
+        return [n for n, in self.conn.execute('SELECT DISTINCT _name FROM dirs UNION SELECT DISTINCT _name FROM files ORDER BY 1')]
+
+    def _load_dirs(self, name):
+        import json
+        return {d: (mtime, n, listed_at, json.loads(entries), json.loads(subdirs))
+                for d, mtime, n, listed_at, entries, subdirs in self.conn.execute(
+                    'SELECT _dir, mtime_ns, entries, listed_at, names, subdirs FROM dirs WHERE _name = ?', (name,))}
+
+    def _save_dirs(self, name, dirs):
+        import json
+        with self.conn:
+            self.conn.execute('DELETE FROM dirs WHERE _name = ?', (name,))
+            self.conn.executemany('INSERT INTO dirs VALUES (?, ?, ?, ?, ?, ?, ?)', (
+                (name, d, mtime, n, listed_at, json.dumps(entries), json.dumps(subdirs))
+                for d, (mtime, n, listed_at, entries, subdirs) in dirs.items()))
+
+    def _add_columns(self, fields):
+        for k in sorted(set(fields) - self.fields):
+            self.conn.execute('ALTER TABLE files ADD COLUMN {}'.format(_sql_name(k)))
+            self.fields.add(k)
+
+    def query(self, *names, **fields):
+        '''Get ``(file, data)`` for the indexed files (sorted).
+
+        Arguments:
+            *names: only include these path names.
+            **fields: field values to match. Strings with ``*``, ``?`` or ``[``
+                are glob patterns, lists/sets match any of their values.
+        '''
+        import json
+        where, args = self._where(names, fields)
+        return [(f, json.loads(data)) for f, data in self.conn.execute(
+            'SELECT _path, _data FROM files{} ORDER BY _path'.format(where), args)]
+
+    def files(self, *names, **fields):
+        '''Get the indexed files (sorted). See ``query``.'''
+        where, args = self._where(names, fields)
+        return [f for f, in self.conn.execute('SELECT _path FROM files{} ORDER BY _path'.format(where), args)]
+
+    def distinct(self, field, *names, **fields):
+        '''Get the (sorted) values of a field. See ``query``.'''
+        if field not in self.fields:
+            return []
+        where, args = self._where(names, fields)
+        col = _sql_name(field)
+        return [v for v, in self.conn.execute('SELECT DISTINCT {0} FROM files{1}{2} {0} IS NOT NULL ORDER BY {0}'.format(
+            col, where, ' AND' if where else ' WHERE'), args)]
+
+    def count(self, *names, **fields):
+        '''Count the indexed files. See ``query``.'''
+        where, args = self._where(names, fields)
+        return self.conn.execute('SELECT COUNT(*) FROM files{}'.format(where), args).fetchone()[0]
+
+    def _where(self, names, fields):
+        conds, args = [], []
+        for col, value in ([('_name', names)] if names else []) + list(fields.items()):
+            if col != '_name' and col not in self.fields:
+                return ' WHERE 0', []  # nothing has this field
+            col = _sql_name(col)
+            if isinstance(value, (list, tuple, set, frozenset)):
+                conds.append('{} IN ({})'.format(col, ', '.join('?' * len(value))))
+                args.extend(_sql_value(v) for v in value)
+            elif isinstance(value, str) and any(c in value for c in '*?['):
+                conds.append('{} GLOB ?'.format(col))
+                args.append(value)
+            else:
+                conds.append('{} = ?'.format(col))
+                args.append(_sql_value(value))
+        return (' WHERE ' + ' AND '.join(conds) if conds else ''), args
+
+def _sql_name(k):
+    return '"{}"'.format(k.replace('"', '""'))
+
+def _sql_value(v):
+    return v if v is None or isinstance(v, (int, float, str)) else str(v)
+
+
+class StatCache(object):
+    '''Remember what exists on the filesystem while in a ``with`` block.
+
+    While active, ``Path.exists``, ``is_file`` and ``is_dir`` look up
+    (and store) results here instead of calling ``stat`` each time, and
+    ``scan`` reuses directory listings (and stores the type of every entry
+    it lists). Writes made through ``Path`` methods drop the affected entries.
+
+    A cache is only used by the thread (or asyncio task) that entered it,
+    but writes from any thread drop entries from every open cache.
+
+    Arguments:
+        ttl (float): how many seconds to trust a result for. None means forever.
+    '''
+    _active = contextvars.ContextVar('pathtree_stat_caches', default=())
+    _open = set()  # in any context
+    _lock = threading.Lock()
+    totals = {'hits': 0, 'misses': 0}  # from caches that have been closed
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self.entries = {}  # abspath -> (time, 'file'|'dir'|'other'|None)
+        self.listings = {}  # abspath -> (time, [os.DirEntry])
+        self.hits = self.misses = 0
+
+    def __enter__(self):
+        StatCache._active.set(StatCache._active.get() + (self,))
+        with StatCache._lock:
+            StatCache._open.add(self)
+        return self
+
+    def __exit__(self, *exc):
+        StatCache._active.set(tuple(c for c in StatCache._active.get() if c is not self))
+        with StatCache._lock:
+            StatCache._open.discard(self)
+            StatCache.totals['hits'] += self.hits
+            StatCache.totals['misses'] += self.misses
+
+    @classmethod
+    def active(cls):
+        '''Get the innermost cache active in this context (or None).'''
+        active = cls._active.get()
+        return active[-1] if active else None
+
+    def kind(self, f):
+        '''Get the type of a path: 'file', 'dir', 'other' or None if it doesn't exist.'''
+        key = os.path.abspath(f)
+        entry = self.entries.get(key)
+        if entry is not None and (self.ttl is None or time.time() - entry[0] < self.ttl):
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        try:
+            mode = os.stat(f).st_mode
+            k = 'dir' if stat.S_ISDIR(mode) else 'file' if stat.S_ISREG(mode) else 'other'
+        except (FileNotFoundError, NotADirectoryError):
+            k = None
+        self.entries[key] = time.time(), k
+        return k
+
+    def scandir(self, d):
+        '''List a directory as a list of ``os.DirEntry``, reusing the listing
+        while it's fresh. Raises like ``os.scandir``.'''
+        key = os.path.abspath(d)
+        listing = self.listings.get(key)
+        if listing is not None and (self.ttl is None or time.time() - listing[0] < self.ttl):
+            self.hits += 1
+            return listing[1]
+        self.misses += 1
+        with os.scandir(d) as it:
+            entries = list(it)
+        self.listings[key] = time.time(), entries
+        self.add_entries(entries)
+        return entries
+
+    def add_entries(self, entries):
+        '''Store the types of ``os.DirEntry`` objects.'''
+        t = time.time()
+        for e in entries:
+            try:
+                k = 'dir' if e.is_dir() else 'file' if e.is_file() else 'other'
+            except OSError:
+                continue
+            self.entries[os.path.abspath(e.path)] = t, k
+
+    def forget(self, f, recursive=False):
+        '''Drop a path (and everything below it if recursive) and its parent directories.'''
+        key = os.path.abspath(f)
+        for cache in (self.entries, self.listings):
+            cache.pop(key, None)
+            for parent in _ancestors(key):
+                cache.pop(parent, None)
+            if recursive:
+                prefix = key.rstrip(os.sep) + os.sep
+                for k in [k for k in list(cache) if k.startswith(prefix)]:
+                    cache.pop(k, None)
+
+class WriterPool(object):
+    '''A pool of files open for appending, keyed by their formatted path.
+
+    At most ``max_open`` files are kept open, closing the least recently
+    used. Parent directories are created the first time a file is opened.
+    Writes are buffered and all open files are flushed every ``flush_every``
+    seconds and when the pool is closed.
+    '''
+    totals = {'hits': 0, 'misses': 0}  # across all pools, for instrumentation
+
+    def __init__(self, max_open=512, flush_every=1., buffering=-1, **kw):
+        if max_open < 1:
+            raise ValueError('max_open must be at least 1, got {!r}'.format(max_open))
+        from collections import OrderedDict
+        self.max_open = max_open
+        self.flush_every = flush_every
+        self.open_kw = dict(kw, buffering=buffering)
+        self.files = OrderedDict()  # formatted path -> file, least recently used first
+        self.hits = self.misses = 0
+        self._dirs = set()
+        self._flushed = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<WriterPool open={} max_open={}>'.format(len(self.files), self.max_open)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def append(self, path, line, **kw):
+        '''Append a line to a file, adding a newline if it doesn't end with one.
+
+        Arguments:
+            path (Path, str): the file. ``Path`` objects are formatted with ``**kw``.
+            line (str): the line to write.
+        '''
+        if not line.endswith('\n'):
+            line += '\n'
+        self.write(path, line, **kw)
+
+    def write(self, path, x, **kw):
+        '''Write a string to the end of a file.'''
+        f = path.format(**kw) if isinstance(path, Path) else os.fspath(path)
+        with self._lock:
+            fh = self.files.get(f)
+            if fh is None:
+                fh = self._open(f)
+            else:
+                self.hits += 1
+                WriterPool.totals['hits'] += 1
+                self.files.move_to_end(f)
+            fh.write(x)
+            if self.flush_every is not None and time.monotonic() - self._flushed >= self.flush_every:
+                self._flush()
+
+    def _open(self, f):
+        self.misses += 1
+        WriterPool.totals['misses'] += 1
+        while len(self.files) >= self.max_open:
+            self.files.popitem(last=False)[1].close()
+        d = os.path.dirname(f)
+        if d and d not in self._dirs:
+            makedirs([d], cache=False)
+            self._dirs.add(d)
+        fh = self.files[f] = _open(f, 'a', **self.open_kw)
+        _invalidate(f)
+        return fh
+
+    def flush(self):
+        '''Flush all open files.'''
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        for fh in self.files.values():
+            fh.flush()
+        self._flushed = time.monotonic()
+
+    def close(self, path=None, **kw):
+        '''Close a file, or all of them if no path is given.'''
+        with self._lock:
+            if path is None:
+                while self.files:
+                    self.files.popitem(last=False)[1].close()
+                return
+            f = path.format(**kw) if isinstance(path, Path) else os.fspath(path)
+            fh = self.files.pop(f, None)
+            if fh is not None:
+                fh.close()
+
+def _invalidate(f, recursive=False, glob=False):
+    '''Drop a path from the open stat caches after changing it.'''
+    if StatCache._open:
+        f = os.fspath(f) if not isinstance(f, Path) else f.partial_format()
+        if glob and '*' in f:
+            f, recursive = os.path.dirname(f.split('*', 1)[0]), True
+        for cache in list(StatCache._open):
+            cache.forget(f, recursive=recursive)
+
+def _lexists(f):
+    cache = StatCache.active()
+    return cache.kind(f) is not None if cache else os.path.lexists(f)
+
+
+class Instrument(object):
+    '''Opt-in counters and timings for pathtree operations.
+
+    Nothing is recorded (or wrapped) until it's enabled. While enabled, the
+    main ``Path``/``Paths`` methods are wrapped to count calls and time them,
+    the filesystem calls pathtree makes are counted, and the cache hit rates
+    are tracked. Disabling puts the original functions back.
+
+    Filesystem calls are counted by swapping the ``os`` module seen by
+    pathtree and ``glob``, so globs made by other code while it's enabled
+    are counted too.
+
+    .. code-block:: python
+
+        pathtree.path.instrument.enable(sample=100)  # time 1 in 100 calls
+        ...
+        paths.stats()
+
+    Arguments:
+        sample (int): time one in every ``sample`` calls (all calls are counted).
+        hook (callable): called as ``hook(op, seconds)`` after each timed call.
+    '''
+    # the operations to time: (owner, attribute, name)
+    OPS = [
+        ('Path', 'format', 'format'), ('Path', 'partial_format', 'partial_format'),
+        ('Path', 'parse', 'parse'), ('Path', 'glob', 'glob'), ('Path', 'scan', 'scan'),
+        ('Path', 'read', 'read'), ('Path', 'write', 'write'), ('Path', 'make', 'make'),
+        ('Path', 'write_many', 'write_many'), ('Path', 'rmtree', 'rmtree'),
+        ('Paths', 'format', 'Paths.format'), ('Paths', 'partial_format', 'Paths.partial_format'),
+        ('Paths', 'match', 'Paths.match'), ('Paths', 'makedirs', 'Paths.makedirs'),
+        (None, 'makedirs', 'makedirs'),
+    ]
+    # the filesystem calls to count: os function -> category
+    FS = {
+        'stat': 'stat', 'lstat': 'stat', 'scandir': 'listdir', 'listdir': 'listdir',
+        'mkdir': 'mkdir', 'makedirs': 'mkdir', 'unlink': 'unlink', 'remove': 'unlink',
+        'rmdir': 'rmdir', 'rename': 'rename', 'open': 'open',
+    }
+    FS_PATH = {'exists': 'stat', 'lexists': 'stat', 'isdir': 'stat', 'isfile': 'stat'}
+
+    def __init__(self):
+        self.enabled = False
+        self.sample = 1
+        self.hook = None
+        self._originals = []
+        self.ops = {}  # name -> [calls, timed calls, seconds]
+        self.fs = dict.fromkeys(sorted(set(self.FS.values())), 0)
+        self._cache_start = self._cache_stop = None
+
+    def __enter__(self):
+        return self.enable() if not self.enabled else self
+
+    def __exit__(self, *exc):
+        self.disable()
+
+    def reset(self):
+        '''Clear the counts.'''
+        self.ops.clear()
+        self.fs.update(dict.fromkeys(self.fs, 0))
+        self._cache_start = self._cache_counts()
+
+    def enable(self, sample=1, hook=None):
+        '''Start recording (from zero).'''
+        if self.enabled:
+            self.disable()
+        self.reset()
+        self.sample, self.hook = max(1, int(sample)), hook
+        module = sys.modules[__name__]
+        for owner, attr, name in self.OPS:
+            target = getattr(module, owner) if owner else module
+            func = target.__dict__[attr] if owner else getattr(module, attr)
+            self._originals.append((target, attr, func))
+            setattr(target, attr, self._wrap(name, func))
+        import glob
+        counting = _CountingModule(os, self.FS, self.fs, path=_CountingModule(os.path, self.FS_PATH, self.fs))
+        for target in (module, glob):
+            self._originals.append((target, 'os', target.os))
+            target.os = counting
+        self.enabled = True
+        return self
+
+    def disable(self):
+        '''Stop recording and unwrap everything. The counts are kept.'''
+        for target, attr, func in reversed(self._originals):
+            setattr(target, attr, func)
+        self._originals.clear()
+        self._cache_stop = self._cache_counts() if self.enabled else self._cache_stop
+        self.enabled = False
+        return self
+
+    def _wrap(self, name, func):
+        ops = self.ops
+        @wraps(func)
+        def timed(*a, **kw):
+            op = ops.get(name)
+            if op is None:
+                op = ops[name] = [0, 0, 0.]
+            op[0] += 1
+            if op[0] % self.sample:
+                return func(*a, **kw)
+            t0 = time.perf_counter()
+            try:
+                return func(*a, **kw)
+            finally:
+                dt = time.perf_counter() - t0
+                op[1] += 1
+                op[2] += dt
+                if self.hook is not None:
+                    self.hook(name, dt)
+        return timed
+
+    @staticmethod
+    def _cache_counts():
+        caches = list(StatCache._open)
+        stat_hits = StatCache.totals['hits'] + sum(c.hits for c in caches)
+        stat_misses = StatCache.totals['misses'] + sum(c.misses for c in caches)
+        return {
+            'compile_pattern': compile_pattern.cache_info()[:2],
+            'compile_parser': compile_parser.cache_info()[:2],
+            'stat_cache': (stat_hits, stat_misses),
+            'makedirs': (_known_dirs_totals['hits'], _known_dirs_totals['misses']),
+            'writer_pool': (WriterPool.totals['hits'], WriterPool.totals['misses']),
+        }
+
+    def report(self, reset=False):
+        '''Get the counts and timings as a dict:
+
+         - ``ops``: ``{name: {calls, timed, seconds, mean}}`` - ``mean`` is per
+           timed call, so ``calls * mean`` estimates the total when sampling.
+         - ``fs``: the number of filesystem calls by type.
+         - ``caches``: ``{name: {hits, misses, hit_rate}}``.
+        '''
+        caches = {}
+        counts = self._cache_counts() if self.enabled else self._cache_stop
+        start = self._cache_start or counts
+        for name, (hits, misses) in (counts or {}).items():
+            h0, m0 = start[name]
+            hits, misses = hits - h0, misses - m0
+            caches[name] = {'hits': hits, 'misses': misses,
+                            'hit_rate': hits / (hits + misses) if hits + misses else None}
+        out = {
+            'ops': {name: {'calls': calls, 'timed': timed, 'seconds': t,
+                           'mean': t / timed if timed else None}
+                    for name, (calls, timed, t) in sorted(self.ops.items())},
+            'fs': dict(self.fs),
+            'caches': caches,
+        }
+        if reset:
+            self.reset()
+        return out
+
+class _CountingModule(object):
+    '''Stand-in for a module (``os``/``os.path``) which counts calls to some of its functions.'''
+    def __init__(self, module, names, counts, **attrs):
+        self._module = module
+        for attr, category in names.items():
+            if hasattr(module, attr):
+                setattr(self, attr, self._counted(getattr(module, attr), category, counts))
+        self.__dict__.update(attrs)
+
+    @staticmethod
+    def _counted(func, category, counts):
+        @wraps(func)
+        def counted(*a, **kw):
+            counts[category] += 1
+            return func(*a, **kw)
+        return counted
+
+    def __getattr__(self, name):
+        return getattr(self._module, name)
+
+instrument = Instrument()
+
+
+# directories that this process has created or seen (absolute paths). The
+# ancestors of every dir in here are in here too.
+_known_dirs = set()
+_known_dirs_totals = {'hits': 0, 'misses': 0}
+
+def makedirs(dirs, workers=None, cache=True):
+    '''Create directories, skipping ancestors of other directories and
+    directories this process already knows exist.
+
+    Arguments:
+        dirs (iterable): the directories to create.
+        workers (int): create the directories using a thread pool.
+        cache (bool): skip directories this process has already created.
+    '''
+    dirs = {os.path.abspath(d) for d in dirs}
+    if cache:
+        n = len(dirs)
+        dirs -= _known_dirs
+        _known_dirs_totals['hits'] += n - len(dirs)
+        _known_dirs_totals['misses'] += len(dirs)
+    ancestors = {a for d in dirs for a in _ancestors(d)}
+    leaves = sorted(dirs - ancestors)
+    _map(_makedir, leaves, workers)
+    _known_dirs.update(dirs, ancestors)
+    return leaves
+
+def _write_file(f, x, mode='', **kw):
+    b = 'b' in mode if mode else isinstance(x, (bytes, bytearray))
+    with (_open(f, 'wb') if b else _open(f, 'w', **kw)) as fh:
+        fh.write(x if b else str(x))
+    _invalidate(f)
+
+def _read_file(f, mode='', **kw):
+    with (_open(f, 'rb') if 'b' in mode else _open(f, **kw)) as fh:
+        return fh.read()
+
+def _open(f, mode='r', *a, **kw):
+    '''``open`` a file using this module's ``os.open`` (so instrumentation counts it).'''
+    return open(f, mode, *a, opener=_opener, **kw)
+
+def _opener(f, flags):
+    return os.open(f, flags, 0o666)
+
+def _touch(f, mode=0o666, exist_ok=True):
+    '''Like ``pathlib.Path.touch``.'''
+    if exist_ok:
+        try:
+            os.utime(f, None)
+            return
+        except OSError:
+            pass
+    os.close(os.open(f, os.O_CREAT | os.O_WRONLY | (0 if exist_ok else os.O_EXCL), mode))
+
+def _rglob(root, pattern):
+    '''Like ``pathlib.Path(root).rglob(pattern)`` (as strings), listing
+    directories with this module's ``os.scandir``.'''
+    import fnmatch
+    parts = [p for p in pattern.split(os.sep) if p] or ['*']
+
+    def listdir(d):
+        try:
+            with os.scandir(d) as it:
+                return list(it)
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            return []
+
+    def select(d, entries, parts):
+        for e in entries:
+            if fnmatch.fnmatch(e.name, parts[0]):
+                if len(parts) == 1:
+                    yield e.path
+                elif e.is_dir():
+                    yield from select(e.path, listdir(e.path), parts[1:])
+
+    def walk(d):
+        entries = listdir(d)
+        yield from select(d, entries, parts)
+        for e in entries:
+            if e.is_dir() and not e.is_symlink():
+                yield from walk(e.path)
+    return walk(root)
+
+def _map(func, items, workers=None):
+    '''Call ``func`` on each item, using a thread pool if there's more than one.'''
+    if workers and len(items) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(workers) as pool:
+            return list(pool.map(func, items))
+    return [func(x) for x in items]
+
+@contextlib.contextmanager
+def _mmap(f, mode='r'):
+    import mmap
+    modes = {'r': mmap.ACCESS_READ, 'r+': mmap.ACCESS_WRITE, 'c': mmap.ACCESS_COPY}
+    if mode not in modes:
+        raise ValueError("mode must be 'r', 'r+' or 'c', got {!r}".format(mode))
+    access = modes[mode]
+    with _open(f, 'r+b' if access == mmap.ACCESS_WRITE else 'rb') as fh:
+        if not os.fstat(fh.fileno()).st_size:  # can't map an empty file
+            yield memoryview(b'')
+            return
+        m = mmap.mmap(fh.fileno(), 0, access=access)
+        try:
+            yield m
+        finally:
+            try:
+                m.close()
+            except BufferError:
+                pass  # arrays still point into it - it's closed once they're garbage collected
+
+def _read_into(f, buffer, offset=0):
+    view = memoryview(buffer).cast('B')
+    n = 0
+    with _open(f, 'rb', buffering=0) as fh:
+        if offset:
+            fh.seek(offset)
+        while n < len(view):
+            k = fh.readinto(view[n:])
+            if not k:
+                break
+            n += k
+    return n
+
+def _makedir(d):
+    os.makedirs(d, exist_ok=True)
+
+def _move_file(pair):
+    src, dst = pair
+    try:
+        os.replace(src, dst)
+    except OSError as e:
+        import errno
+        if e.errno != errno.EXDEV:
+            raise
+        import shutil
+        shutil.move(src, dst)  # another device - copy then delete
+    forget_dirs(src)
+    _invalidate(src, recursive=True)
+    _invalidate(dst, recursive=True)
+    return pair
+
+def _copy_file(pair):
+    import shutil
+    src, dst = pair
+    if os.path.isdir(src):
+        shutil.copytree(src, dst, dirs_exist_ok=True)
+    else:
+        shutil.copy2(src, dst)
+    _invalidate(dst, recursive=True)
+    return pair
+
+def _link_file(pair):
+    src, dst = pair
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        if not os.path.samefile(src, dst):  # already linked by an interrupted run
+            raise
+    except OSError as e:
+        import errno
+        if e.errno not in (errno.EXDEV, errno.EPERM):
+            raise
+        return _copy_file(pair)  # another device / can't link - copy
+    _invalidate(dst)
+    return pair
+
+_MIGRATE = {'move': _move_file, 'copy': _copy_file, 'hardlink': _link_file}
+
+# the max number of threads used for the async methods
+ASYNC_WORKERS = 32
+_async_pool = None
+_async_lock = threading.Lock()
+
+def set_async_workers(n):
+    '''Change the number of threads used by the async methods.'''
+    global ASYNC_WORKERS, _async_pool
+    with _async_lock:
+        ASYNC_WORKERS, pool, _async_pool = n, _async_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False)
+
+def _async_executor():
+    global _async_pool
+    if _async_pool is None:
+        with _async_lock:
+            if _async_pool is None:
+                from concurrent.futures import ThreadPoolExecutor
+                _async_pool = ThreadPoolExecutor(ASYNC_WORKERS, thread_name_prefix='pathtree')
+    return _async_pool
+
+async def _run_async(func, *a, **kw):
+    '''Run a blocking function on the shared executor.'''
+    import asyncio
+    loop = asyncio.get_event_loop()
+    ctx = contextvars.copy_context()  # e.g. so an active snapshot is used
+    return await loop.run_in_executor(_async_executor(), lambda: ctx.run(func, *a, **kw))
+
+async def _gather(func, items, limit=None):
+    '''Call ``func`` on each item on the shared executor with at most ``limit``
+    in flight at once. Returns the results in order.'''
+    import asyncio
+    sem = asyncio.Semaphore(limit or ASYNC_WORKERS)
+    async def run(x):
+        async with sem:
+            return await _run_async(func, x)
+    return await asyncio.gather(*(run(x) for x in items))
+
+async def _aiterate(make_iter, chunk=256):
+    '''Pull items from a blocking iterator in chunks on the shared executor.'''
+    it = await _run_async(make_iter)
+    while True:
+        items = await _run_async(lambda: list(itertools.islice(it, chunk)))
+        for x in items:
+            yield x
+        if len(items) < chunk:
+            return
+
+
+# remove trees relative to open directory fds (like shutil.rmtree) where possible
+_RMTREE_FD = ({os.open, os.rmdir, os.unlink} <= os.supports_dir_fd and
+              os.scandir in os.supports_fd)
+_DIR_FLAGS = os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0) | getattr(os, 'O_NOFOLLOW', 0)
+
+def _rmtree(top, include=True, workers=None, dry_run=False):
+    '''Remove a directory tree bottom-up, holding one directory listing at a time.'''
+    counts = {'files': 0, 'dirs': 0}
+    if dry_run:
+        counts['bytes'] = 0
+    pool = None
+    if workers:
+        from concurrent.futures import ThreadPoolExecutor
+        pool = ThreadPoolExecutor(workers)
+    try:
+        fd = os.open(top, _DIR_FLAGS) if _RMTREE_FD else None
+        try:
+            _rmtree_dir(top, fd, pool, dry_run, counts)
+        finally:
+            if fd is not None:
+                os.close(fd)
+        if include:
+            if not dry_run:
+                os.rmdir(top)
+            counts['dirs'] += 1
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return counts
+
+def _rmtree_dir(path, fd, pool, dry_run, counts):
+    '''Empty a directory (given by path, or by an open fd if not None).'''
+    kw = {} if fd is None else {'dir_fd': fd}
+    name = (lambda n: n) if fd is not None else (lambda n: os.path.join(path, n))
+    with os.scandir(path if fd is None else fd) as it:
+        entries = list(it)
+
+    files = []
+    for e in entries:
+        if not e.is_dir(follow_symlinks=False):
+            files.append(e)
+            continue
+        sub = os.open(e.name, _DIR_FLAGS, dir_fd=fd) if fd is not None else None
+        try:
+            _rmtree_dir(os.path.join(path, e.name), sub, pool, dry_run, counts)
+        finally:
+            if sub is not None:
+                os.close(sub)
+        if not dry_run:
+            os.rmdir(name(e.name), **kw)
+        counts['dirs'] += 1
+
+    counts['files'] += len(files)
+    if dry_run:
+        counts['bytes'] += sum(e.stat(follow_symlinks=False).st_size for e in files)
+    elif pool is not None and len(files) > 1:
+        list(pool.map(lambda e: os.unlink(name(e.name), **kw), files))
+    else:
+        for e in files:
+            os.unlink(name(e.name), **kw)
+
+def _ancestors(d):
+    parent = os.path.dirname(d)
+    while parent != d:
+        yield parent
+        d, parent = parent, os.path.dirname(parent)
+
+def forget_dirs(path=None, glob=False):
+    '''Remove a directory and everything under it from the makedirs cache.
+    Pass nothing to clear the whole cache.'''
+    if path is None:
+        _known_dirs.clear()
+        return
+    path = os.path.abspath(path)
+    if glob:  # everything below the first wildcard
+        path = os.path.dirname(path.split('*', 1)[0]) if '*' in path else path
+    if path not in _known_dirs:  # the ancestors of known dirs are known too
+        return
+    prefix = path.rstrip(os.sep) + os.sep
+    _known_dirs.difference_update({d for d in _known_dirs if d == path or d.startswith(prefix)})
+
+
+# the next free index for (file, suffix) handed out by next_unique(scan=True)
+_unique_counters = {}
+_unique_lock = threading.Lock()
+
+def _next_unique(f, suffix='_{:02}', i=1, k=1, create=False):
+    '''Reserve ``k`` unused names for ``f``, listing its directory at most once.'''
+    froot, ext = os.path.splitext(f)
+    sfx = suffix if callable(suffix) else suffix.format
+    key = os.path.abspath(f), suffix
+    names = []
+    with _unique_lock:
+        n = _unique_counters.get(key)
+        if n is None:
+            n, free = _last_unique(f, suffix, i)
+            if free and _reserve(f, create):
+                names.append(f)
+        while len(names) < k:
+            fi, n = '{}{}{}'.format(froot, sfx(n), ext), n + 1
+            if _reserve(fi, create):
+                names.append(fi)
+        _unique_counters[key] = n
+    return names
+
+def _last_unique(f, suffix, i):
+    '''Get the index after the largest existing suffix of ``f`` and whether
+    ``f`` itself is free.'''
+    froot, ext = os.path.splitext(f)
+    fields = [] if callable(suffix) else list(_string.formatter_parser(suffix))
+    if sum(field is not None for _, field, _, _ in fields) != 1:
+        # can't turn the suffix into a regex - check each name in turn
+        sfx = suffix if callable(suffix) else suffix.format
+        while os.path.exists('{}{}{}'.format(froot, sfx(i), ext)):
+            i += 1
+        return i, not os.path.exists(f)
+
+    j = next(j for j, (_, field, _, _) in enumerate(fields) if field is not None)
+    before = ''.join(lit for lit, _, _, _ in fields[:j + 1])
+    after = ''.join(lit for lit, _, _, _ in fields[j + 1:])
+    name = os.path.basename(froot)
+    import re
+    regex = re.compile('{}(\\d+){}$'.format(re.escape(name + before), re.escape(after + ext)))
+    try:
+        entries = os.listdir(os.path.dirname(f) or '.')
+    except (FileNotFoundError, NotADirectoryError):
+        return i, True
+    found = (regex.match(e) for e in entries)
+    n = max([i] + [int(m.group(1)) + 1 for m in found if m])
+    return n, os.path.basename(f) not in entries
+
+def _reserve(f, create):
+    '''Claim a filename - with ``create``, only if no one else has created it.'''
+    if not create:
+        return True
+    try:
+        os.close(os.open(f, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        return False
+    _invalidate(f)
+    return True
+
+def forget_unique(path=None):
+    '''Forget the indices handed out by ``next_unique(scan=True)`` for a file
+    (or all files) so the directory is listed again next time.'''
+    with _unique_lock:
+        if path is None:
+            _unique_counters.clear()
+            return
+        path = os.path.abspath(path)
+        for key in [key for key in _unique_counters if key[0] == path]:
+            del _unique_counters[key]
+
 
 def sglob(*f):
     '''Enhanced glob. Pass path parts and return sorted list of files.'''
+    import glob
     return sorted(glob.glob(os.path.join(*f)))
 
 def fbase(f, up=0):
@@ -567,6 +2851,291 @@ def backup(path, mode='index'):
 
 
 
+'''
+
+Compiled Patterns
+
+'''
+
+class Template(object):
+    '''A path pattern that has been parsed once into literal and field segments.
+
+    Rendering walks the pre-split segments and looks each field up in a sequence
+    of data mappings (e.g. ``(kw, path.data, paths.data)``) so nothing needs to
+    be re-parsed or merged on each call. Patterns that use features the
+    compiled form doesn't handle (positional or nested fields) fall back to
+    ``str.format`` / ``pformat`` / ``gformat``.
+
+    Example
+    -------
+    >>> t = compile_pattern('{root}/epoch_{i_epoch:04d}/{name}.png')
+    >>> t.format(({'root': 'logs', 'i_epoch': 5, 'name': 'f1'},))
+    'logs/epoch_0005/f1.png'
+    >>> t.partial_format(({'root': 'logs'},))
+    'logs/epoch_{i_epoch:04d}/{name}.png'
+    >>> t.glob_format(({'root': 'logs'},))
+    'logs/epoch_*/*.png'
+    '''
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.segments = []
+        self.compiled = True
+        for literal, key, spec, conv in _string.formatter_parser(pattern):
+            field = None
+            if key is not None:
+                name, rest = _string.formatter_field_name_split(key)
+                if not isinstance(name, str) or not name or '{' in spec:
+                    self.compiled = False
+                text = '{' + key + ('!' + conv if conv else '') + (':' + spec if spec else '') + '}'
+                field = (name, tuple(rest), conv, spec, text)
+            self.segments.append((literal, field))
+        self.fields = frozenset(f[0] for _, f in self.segments if f)
+        self.literal = (''.join(l for l, _ in self.segments)
+                        if self.compiled and not self.fields else None)
+
+    def __repr__(self):
+        return '<Template "{}">'.format(self.pattern)
+
+    def format(self, maps):
+        '''Fill all fields. Raises KeyError for the first missing field.'''
+        if self.literal is not None:
+            return self.literal
+        if not self.compiled:
+            return self.pattern.format(**_merge(maps))
+        return self.pattern.format_map(_merge(maps))
+
+    def partial_format(self, maps):
+        '''Fill available fields, leaving missing fields in the pattern.'''
+        return self._render(maps, _KEEP, 'pformat')
+
+    def glob_format(self, maps):
+        '''Fill available fields, replacing missing fields with an asterisk.'''
+        return self._render(maps, '*', 'gformat')
+
+    def _render(self, maps, missing, fallback):
+        if self.literal is not None:
+            return self.literal
+        data = _merge(maps)
+        if not self.compiled:  # fallback is the name of the pformat function to use
+            import pformat
+            return getattr(pformat, fallback)(self.pattern, **data)
+        if self.fields.issubset(data):
+            try:
+                return self.pattern.format_map(data)
+            except (KeyError, IndexError, AttributeError):
+                pass  # a missing attribute/item - handled below
+
+        out = []
+        for literal, field in self.segments:
+            if literal:
+                out.append(literal)
+            if field is None:
+                continue
+            name, rest, conv, spec, text = field
+            try:
+                obj = data[name]
+                for is_attr, i in rest:
+                    obj = getattr(obj, i) if is_attr else obj[i]
+            except (KeyError, IndexError, AttributeError):
+                out.append(text if missing is _KEEP else missing)
+                continue
+            if conv:
+                obj = str(obj) if conv == 's' else repr(obj) if conv == 'r' else ascii(obj)
+            out.append(format(obj, spec))
+        return ''.join(out)
+
+
+_KEEP = object()
+
+
+@lru_cache(maxsize=4096)
+def compile_pattern(pattern):
+    '''Parse a format pattern into a (cached) Template.'''
+    return Template(pattern)
+
+
+def _split_pattern(pattern):
+    '''Split a format pattern into path components, only splitting on the
+    separators outside of its fields. Returns None if a field contains one
+    (e.g. ``{date:%Y/%m/%d}``).'''
+    if any(f is not None and os.sep in f[4] for _, f in compile_pattern(pattern).segments):
+        return None
+    return pattern.split(os.sep)
+
+
+class SegmentTree(object):
+    '''Path patterns as a tree of path components.
+
+    The named paths in a tree share most of their directories (e.g.
+    ``{root}/{log_id}/plots``), so formatting the whole collection formats
+    each component once and reuses it for every path below it.
+
+    Arguments:
+        patterns (iterable): ``(name, pattern)`` tuples.
+    '''
+    def __init__(self, patterns):
+        self.nodes = []  # (parent index, template)
+        self.names = {}  # name -> node index
+        index = {}
+        self.compiled = True
+        for name, pattern in patterns:
+            parts = _split_pattern(pattern)
+            if parts is None:  # a field contains a separator
+                self.compiled = False
+                return
+            i = -1
+            for part in parts:
+                key = i, part
+                if key not in index:
+                    index[key] = len(self.nodes)
+                    self.nodes.append((i, compile_pattern(part)))
+                i = index[key]
+            self.names[name] = i
+        self.compiled = all(t.compiled for _, t in self.nodes)
+
+    def format_nodes(self, data):
+        '''Partially format every node, returning a list of
+        ``(partially formatted string, is fully specified)``.'''
+        maps = data,
+        out = []
+        for parent, t in self.nodes:
+            f, complete = t.partial_format(maps), t.fields.issubset(data)
+            if parent >= 0:
+                parent_f, parent_complete = out[parent]
+                f, complete = parent_f + os.sep + f, complete and parent_complete
+            out.append((f, complete))
+        return out
+
+    def partial_format(self, data):
+        '''Partially format every pattern.
+
+        Returns:
+            dict of name -> (partially formatted string, is fully specified)
+        '''
+        out = self.format_nodes(data)
+        return {name: out[i] for name, i in self.names.items()}
+
+    def parent_dirs(self, data):
+        '''Get the fully specified parent directory of each pattern.'''
+        out = self.format_nodes(data)
+        parents = (self.nodes[i][0] for i in self.names.values())
+        return {out[i][0] for i in parents if i >= 0 and out[i][1]}
+
+
+class PatternIndex(object):
+    '''Reverse lookup from a path string to the pattern that can parse it.
+
+    Patterns are stored in a trie of their path components. Literal
+    components (``plots``) are looked up directly and components with fields
+    (``{step_name}``, ``epoch_{i:04d}.png``) are checked against their literal
+    prefix and suffix, so a lookup only parses the patterns whose components
+    all agree with the path. A field can also match across directories
+    (``{date}`` matching ``2020/01``), so patterns with fewer components than
+    the path are found using a second trie keyed on their (reversed) literal
+    suffix, e.g. ``'.png'`` or ``'/model.h5'``.
+
+    Arguments:
+        patterns (iterable): ``(name, pattern, data)`` tuples. ``data`` is
+            merged under the parsed fields.
+    '''
+    def __init__(self, patterns):
+        self.parts = {}  # number of components -> [literals, fields, entries] trie
+        self.suffixes = {}  # reversed literal suffix -> (number of components, entry)
+        self.shortest = None
+        for order, (name, pattern, data) in enumerate(patterns):
+            segments = compile_pattern(pattern).segments
+            literals = [l for l, _ in segments] or ['']
+            if segments and segments[-1][1] is not None:  # ends with a field
+                literals.append('')
+            prefix, suffix = literals[0].lower(), literals[-1].lower()
+            entry = (-sum(map(len, literals)), order, name,
+                     prefix, compile_parser(pattern), data)
+
+            if any(f for _, f in segments):  # only fields can span components
+                n = sum(l.count(os.sep) for l in literals) + 1
+                self.shortest = n if self.shortest is None else min(self.shortest, n)
+                node = self.suffixes
+                for c in reversed(suffix):
+                    node = node.setdefault(c, {})
+                node.setdefault(None, {}).setdefault(n, []).append(entry)
+
+            parts = _split_pattern(pattern)
+            if parts is None:
+                continue
+            node = self.parts.setdefault(len(parts), [{}, {}, []])
+            for part in parts:
+                t = compile_pattern(part)
+                if t.literal is not None:
+                    children, key = node[0], t.literal.lower()
+                else:
+                    first, last = t.segments[0], t.segments[-1]
+                    children, key = node[1], (first[0].lower(), '' if last[1] else last[0].lower())
+                node = children.get(key) or children.setdefault(key, [{}, {}, []])
+            node[2].append(entry)
+
+    def candidates(self, path):
+        '''Get the patterns whose literal components match the path (most specific first).'''
+        s = path.lower()
+        parts = s.split(os.sep)
+        level = [self.parts[len(parts)]] if len(parts) in self.parts else []
+        for part in parts:
+            if not level:
+                break
+            found = []
+            for literals, fields, _ in level:
+                child = literals.get(part)
+                if child is not None:
+                    found.append(child)
+                for (start, end), child in fields.items():
+                    if (len(part) >= len(start) + len(end) and
+                            part.startswith(start) and part.endswith(end)):
+                        found.append(child)
+            level = found
+        found = [e for node in level for e in node[2]]
+
+        # patterns where a field has to span several components
+        if self.shortest is not None and self.shortest < len(parts):
+            n, node = len(parts), self.suffixes
+            for c in itertools.chain(reversed(s), [None]):
+                for k, entries in node.get(None, {}).items():
+                    if k < n:
+                        found.extend(entries)
+                node = node.get(c) if c is not None else None
+                if node is None:
+                    break
+        return [e for e in sorted(found) if s.startswith(e[3])]
+
+    def match(self, path):
+        '''Get ``(name, data)`` for the best matching pattern, or None.'''
+        path = os.fspath(path)
+        for _, _, name, _, parser, data in self.candidates(path):
+            r = parser.parse(path)
+            if r is not None:
+                return name, {**data, **r.named}
+        return None
+
+
+@lru_cache(maxsize=4096)
+def compile_parser(pattern, case_sensitive=False):
+    '''Compile a parse pattern into a (cached) ``parse.Parser``.'''
+    import parse
+    return parse.compile(pattern, case_sensitive=case_sensitive)
+
+
+def _merge(maps):
+    '''Flatten data layers into a single dict (first layer wins).'''
+    if len(maps) == 1:
+        return maps[0]
+    if len(maps) == 2:
+        return {**maps[1], **maps[0]}
+    if len(maps) == 3:
+        return {**maps[2], **maps[1], **maps[0]}
+    data = {}
+    for m in reversed(maps):
+        data.update(m)
+    return data
+
+
 def get_keys(data, keys=None, iters_as_keys=False):
     '''Recursively traverse a nested dict and return the trail of keys, and the final value'''
     keys = tuple(keys or ())
@@ -581,15 +3150,21 @@ def get_keys(data, keys=None, iters_as_keys=False):
         else:
             yield keys_, value
 
-example = tree({
-    'data': {
-        '{date}': {
-            '': 'date',
-            '{labels_set}.csv': 'csv',
-            'flac': {
-                '': 'flac_root',
-                '{name}.flac': 'flac',
+def __getattr__(name):
+    # build the example tree on first access instead of at import
+    if name == 'example':
+        global example
+        example = tree({
+            'data': {
+                '{date}': {
+                    '': 'date',
+                    '{labels_set}.csv': 'csv',
+                    'flac': {
+                        '': 'flac_root',
+                        '{name}.flac': 'flac',
+                    }
+                }
             }
-        }
-    }
-})
+        })
+        return example
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
@@ -1,4 +1,7 @@
 import os
+import time
+import datetime
+import pathlib
 import pathtree as pt
 import pytest
 
@@ -83,6 +86,64 @@ def test_specify(base_paths):
     assert not base_paths.fully_specified
     assert paths.specify(log_id=1, step_name=2, plot_name=3).fully_specified
 
+    # Test: missing_fields, requires
+
+    assert paths.model.missing_fields() == set()
+    assert paths.plot.missing_fields() == {'step_name', 'plot_name'}
+    assert paths.plot.missing_fields(step_name=1) == {'plot_name'}
+    assert paths.missing_fields() == {
+        'plot': {'step_name', 'plot_name'}, 'plot_jpg': {'step_name', 'plot_name'},
+        'result_step': {'step_name'}, 'model_step': {'step_name'}}
+    assert paths.requires('plot_name') == ['plot', 'plot_jpg']
+    assert set(paths.requires('log_id')) == set(paths) - {'root', 'meta'}
+    assert paths.requires('nothing') == []
+
+
+
+def test_specify_copy_on_write(base_paths):
+    base = base_paths.specify(log_id='a')
+    model = base.model.update(x=1)
+    paths = base.specify(step_name='s')
+    assert paths.data.version != base.data.version
+    assert paths.model is not model and paths.model.data == {'x': 1}
+    # paths that weren't accessed are only built on access
+    assert 'plot' not in paths._paths.bound and paths.plot.format(plot_name='p') == 'logs/a/plots/s/p.png'
+
+    # changes after copying don't leak between copies
+    model.update(y=2)
+    base.update(log_id='b')
+    base.unspecify('root', inplace=True)
+    assert paths.model.data == {'x': 1} and paths.model.format() == 'logs/a/model.h5'
+    assert 'root' not in base.data and base.model.partial_format() == '{root}/b/model.h5'
+    assert paths.unspecify('log_id').data == {'root': 'logs', 'step_name': 's'}
+    assert paths.model.unspecify('log_id').partial_format() == 'logs/{log_id}/model.h5'
+
+    # paths changed in place don't stop copies from sharing the definitions
+    tree = base._paths.tree()
+    copy = base.specify(step_name='t')
+    assert copy._paths.source is base._paths.source and copy._paths.tree() is tree
+    assert copy.model.data == {'x': 1, 'y': 2}
+    base.model.data['z'] = 3  # changed directly
+    assert base.specify().model.data == {'x': 1, 'y': 2, 'z': 3}
+    import pickle
+    assert pickle.loads(pickle.dumps(base)).model.data == {'x': 1, 'y': 2, 'z': 3}
+
+    # data layers are squashed as they get deep
+    for i in range(20):
+        paths = paths.specify(i=i)
+    assert len(paths.data.layers) <= pt.path.Scope.MAX_DEPTH + 1 and paths.data['i'] == 19
+
+
+def test_path_compact(base_paths):
+    p = base_paths.model
+    assert isinstance(p, os.PathLike) and not hasattr(p, '__dict__')
+    assert p.copy.path_pattern is p.path_pattern
+    assert p.data is p.copy.data is pt.path.EMPTY
+    with pytest.raises(TypeError):
+        p.data['x'] = 1
+    assert p.specify(x=1).data == {'x': 1} and p.data == {}
+    assert p._path == pathlib.Path('{root}/{log_id}/model.h5')
+    assert pt.Path('a/./b/', 'c').path_pattern == 'a/b/c' and pt.Path().path_pattern == '.'
 
 
 def test_format(base_paths):
@@ -133,6 +194,49 @@ def test_format(base_paths):
         assert f == 'logs/a/plots/epoch_100/{}.png'.format(n)
 
 
+def test_format_all(base_paths):
+    paths = base_paths.specify(log_id='a')
+    paths.plot.update(plot_name='p')
+    paths.add('root', {'{x!r}/{{lit}}': 'odd'})
+
+    def expected(**kw):
+        return {name: paths[name].maybe_format(**kw) for name in paths}
+
+    for kw in [{}, {'step_name': 's'}, {'step_name': 's', 'plot_name': 'q', 'x': 1}]:
+        f, exp = paths.format(**kw), expected(**kw)
+        assert list(f) == list(exp)
+        for name in exp:
+            assert type(f[name]) == type(exp[name]) and str(f[name]) == str(exp[name])
+        assert paths.partial_format(**kw) == {name: paths[name].partial_format(**kw) for name in paths}
+    assert paths.format()['plot'].partial_format() == 'logs/a/plots/{step_name}/p.png'
+    assert 'logs/a/plots/{step_name}/p.png' in repr(paths)
+
+    # cached until the data changes
+    assert paths._format_all({}) is paths._format_all({})
+    paths.update(log_id='b')
+    assert paths.partial_format()['model'] == 'logs/b/model.h5'
+    paths.plot.update(plot_name='q')
+    assert paths.partial_format()['plot'] == 'logs/b/plots/{step_name}/q.png'
+    # including when a path's data is changed directly
+    paths.plot.data['step_name'] = 'zz'
+    assert paths.format()['plot'] == paths.plot.format() == 'logs/b/plots/zz/q.png'
+    assert 'logs/b/plots/zz/q.png' in repr(paths)
+    # or the paths do
+    paths.paths['extra'] = pt.Path('{root}/extra.txt')
+    assert paths.format()['extra'] == 'logs/extra.txt' and 'extra.txt' in repr(paths)
+    del paths.paths['model']
+    assert 'model' not in paths.format() and 'model' not in paths.partial_format()
+    assert 'model.h5' not in repr(paths)
+
+    # fields with a separator in their format spec
+    paths = pt.tree('logs', {'{date:%Y/%m/%d}': {'x.txt': 'x'}})
+    assert paths.partial_format() == {'root': 'logs', 'x': 'logs/{date:%Y/%m/%d}/x.txt'}
+    assert 'logs/{date:%Y/%m/%d}/x.txt' in repr(paths)
+    d = datetime.date(2020, 1, 2)
+    assert paths.format(date=d) == {'root': 'logs', 'x': 'logs/2020/01/02/x.txt'}
+    assert paths._paths.tree() is None
+
+
 def test_add(paths):
     # Test: Paths.add
 
@@ -184,6 +288,666 @@ def test_parse(base_paths):
         paths.plot.parse('broken/some/logs/12345/plots/0002/f1_score.png')
     # TODO: More intensive parse tests
 
+    # Test: parse_many
+
+    files = [png_file, 'some/logs/12345/plots/0003/loss.png', 'not/a/match.png']
+    with pytest.raises(ValueError):
+        list(paths.plot.parse_many(files))
+    parsed = list(paths.plot.parse_many(files, errors='skip'))
+    assert [f for f, _ in parsed] == files[:2]
+    assert set(parsed[0][1].items()) == set(expected.items())
+    assert parsed[1][1]['plot_name'] == 'loss'
+
+    cols = paths.plot.parse_many(files[:2], columns=True)
+    assert cols['path'] == files[:2]
+    assert cols['step_name'] == ['0002', '0003']
+    assert cols['root'] == ['some/logs', 'some/logs']
+
+
+def test_match(base_paths):
+    paths = base_paths.specify(root='some/logs')
+    assert paths.match('some/logs/12345/plots/0002/f1_score.jpg') == ('plot_jpg', dict(
+        paths.data, log_id='12345', step_name='0002', plot_name='f1_score'))
+    assert paths.match('some/logs/12345/model.h5')[0] == 'model'
+    assert paths.match('some/logs/meta.json')[0] == 'meta'
+    assert paths.match('some/logs')[0] == 'root'
+    with pytest.raises(ValueError):
+        paths.match('other/logs/meta.json')
+
+    files = ['some/logs/1/results/a.csv', 'nope.txt', 'some/logs/1/models/a.h5']
+    assert [(f, n) for f, n, _ in paths.match_many(files, errors='skip')] == [
+        (files[0], 'result_step'), (files[2], 'model_step')]
+    with pytest.raises(ValueError):
+        list(paths.match_many(files))
+
+    # the index is rebuilt when patterns or data change
+    paths.add('root', {'{log_id}': {'notes.txt': 'notes'}})
+    assert paths.match('some/logs/1/notes.txt')[0] == 'notes'
+    paths.notes.suffix('_{i}').assign_name('notes_i')
+    assert paths.match('some/logs/1/notes_2.txt') == ('notes_i', dict(paths.data, log_id='1', i='2'))
+    paths.update(log_id='1')
+    with pytest.raises(ValueError):
+        paths.match('some/logs/2/notes.txt')
+
+
+def test_match_index():
+    # many patterns with the same extension only parse the ones whose components agree
+    paths = pt.tree('logs', {'{log_id}': {'g{}'.format(i): {'{step}': {
+        'file{}_{{name}}.csv'.format(j): 'f{}_{}'.format(i, j) for j in range(10)}} for i in range(20)}})
+    index = paths._index()
+    assert [e[2] for e in index.candidates('logs/a/g13/b/file7_c.csv')] == ['f13_7']
+    assert paths.match('LOGS/a/G13/b/File7_c.csv')[0] == 'f13_7'
+    # a field can still span directories
+    paths = pt.tree('logs', {'{date}': {'x.txt': 'x', 'y.txt': 'y'}, 'a': {'x.txt': 'ax'}})
+    assert paths.match('logs/2020/01/x.txt') == ('x', {'root': 'logs', 'date': '2020/01'})
+    assert paths.match('logs/a/x.txt')[0] == 'ax'
+
+
+def test_scan(tmp_path):
+    paths = pt.tree(str(tmp_path), {
+        '{log_id}': {'plots': {'epoch_{i_epoch:04d}': {'{plot_name}.png': 'plot'}}},
+    })
+    for f in ['a/plots/epoch_0001/f1.png', 'a/plots/epoch_0002/loss.png', 'b/plots/epoch_0001/f1.png',
+              'b/plots/epoch_xxxx/f1.png', 'b/plots/epoch_0003/f1.jpg', 'b/plots/.epoch_0004/f1.png']:
+        paths.plot.repath(os.path.join(str(tmp_path), f)).touch()
+
+    found = list(paths.plot.scan())
+    assert [f for f, _ in found] == sorted(paths.plot.glob())[:3]
+    assert [(d['log_id'], d['i_epoch'], d['plot_name']) for _, d in found] == [
+        ('a', 1, 'f1'), ('a', 2, 'loss'), ('b', 1, 'f1')]
+    assert found[0][1]['root'] == str(tmp_path)
+
+    assert [d['plot_name'] for _, d in paths.plot.specify(log_id='a', i_epoch=2).walk()] == ['loss']
+    assert list(paths.plot.specify(log_id='c').scan()) == []
+    assert [f for f, _ in paths.plot.specify(log_id='a', i_epoch=1, plot_name='f1').scan()] == [
+        os.path.join(str(tmp_path), 'a/plots/epoch_0001/f1.png')]
+
+    # a field that spans directories
+    paths = pt.tree(str(tmp_path / 'dates'), {'{date:%Y/%m/%d}': {'{name}.txt': 'x'}})
+    for d in [datetime.date(2020, 1, 2), datetime.date(2021, 3, 4)]:
+        paths.x.specify(date=d, name='a').touch()
+    (tmp_path / 'dates' / 'notes.txt').touch()
+    assert [(d['date'], d['name']) for _, d in paths.x.scan()] == [
+        (datetime.date(2020, 1, 2), 'a'), (datetime.date(2021, 3, 4), 'a')]
+    assert all(os.path.isfile(f) for f, _ in paths.x.scan())
+    paths.specify(date=datetime.date(2022, 5, 6)).makedirs()
+    assert os.path.isdir(str(tmp_path / 'dates/2022/05/06'))
+
+
+def test_glob_constraints(tmp_path, monkeypatch):
+    paths = pt.tree(str(tmp_path), {'{date}': {'epoch_{i_epoch:04d}': {'{name}.flac': 'flac'}}})
+    for date in ['2020-01-01', '2020-01-02', '2021-01-01']:
+        for i in range(5):
+            for name in 'ab':
+                paths.flac.specify(date=date, i_epoch=i, name=name).touch()
+
+    def check(expected, **constraints):
+        found = paths.flac.glob(**constraints)
+        assert found == sorted(paths.flac.format(**d) for d in expected)
+        assert sorted(paths.flac.iglob(**constraints)) == found
+
+    check([dict(date=d, i_epoch=1, name=n) for d in ['2020-01-01', '2021-01-01'] for n in 'ab'],
+          date={'2020-01-01', '2021-01-01', '1999-01-01'}, i_epoch=1)
+    check([dict(date='2020-01-02', i_epoch=i, name='b') for i in range(2, 4)],
+          date='2020-01-02', i_epoch=range(2, 4), name=lambda n: n == 'b')
+    check([dict(date=d, i_epoch=4, name=n) for d in ['2020-01-01', '2020-01-02'] for n in 'ab'],
+          date=lambda d: d.startswith('2020'), i_epoch=range(4, 10000))
+    assert paths.globs('flac', date={'2021-01-01'}, i_epoch=[0, '3'], name='a') == [
+        paths.flac.format(date='2021-01-01', i_epoch=i, name='a') for i in (0, 3)]
+
+    # extra components are globbed below the matches
+    epochs = paths.flac.up()
+    assert epochs.glob('*.flac', date={'2021-01-01'}, i_epoch={1}) == [
+        paths.flac.format(date='2021-01-01', i_epoch=1, name=n) for n in 'ab']
+    assert epochs.glob('a.flac', date={'2021-01-01'}, i_epoch=2) == [
+        paths.flac.format(date='2021-01-01', i_epoch=2, name='a')]
+    # constraints on specified fields are checked against their value
+    assert paths.flac.specify(date='2021-01-01').glob(date={'2020-01-01'}) == []
+    assert len(paths.flac.specify(date='2021-01-01').glob(date={'2021-01-01'}, i_epoch=1)) == 2
+    with pytest.raises(KeyError):
+        paths.flac.glob(nmae={'a'})
+    with pytest.raises(KeyError):
+        paths.globs('flac', nmae={'a'})
+    for bad in [None, (n for n in 'ab')]:
+        with pytest.raises(TypeError):
+            paths.flac.glob(name=bad)
+
+    # small value sets are checked directly without listing any directories
+    def scandir(*a, **kw):
+        raise AssertionError('listed a directory')
+    monkeypatch.setattr(os, 'scandir', scandir)
+    assert len(paths.flac.glob(date={'2020-01-01', '2020-01-02'}, i_epoch=range(3), name=['a', 'b'])) == 12
+
+
+def test_makedirs(tmp_path, monkeypatch):
+    paths = pt.tree(str(tmp_path), {
+        '{log_id}': {
+            'model.h5': 'model',
+            'plots': {'{step_name}': {'{plot_name}.png': 'plot', '{plot_name}.jpg': 'plot_jpg', '': 'plot_dir'}},
+            'results': {'{step_name}.csv': 'result_step'},
+        },
+    }).specify(log_id='a', step_name='s')
+
+    made = []
+    makedir = pt.path._makedir
+    monkeypatch.setattr(pt.path, '_makedir', lambda d: made.append(d) or makedir(d))
+    pt.path.forget_dirs()
+    paths.makedirs()
+    # only the deepest directories are created, once each
+    assert sorted(made) == [os.path.join(str(tmp_path), 'a', d) for d in ('plots/s', 'results')]
+    assert os.path.isdir(os.path.join(str(tmp_path), 'a/plots/s'))
+
+    made.clear()
+    paths.makedirs()
+    paths.specify(step_name='t').makedirs(workers=2)
+    assert made == [os.path.join(str(tmp_path), 'a/plots/t')]
+
+    # removing a directory drops it from the cache
+    paths.plot_dir.rm()
+    made.clear()
+    paths.makedirs()
+    assert made == [os.path.join(str(tmp_path), 'a/plots/s')]
+    paths.plot_dir.rmdir()
+    made.clear()
+    paths.makedirs()
+    assert made == [os.path.join(str(tmp_path), 'a/plots/s')]
+    # and so does moving it
+    paths.plot_dir.move(str(tmp_path / 'moved'))
+    made.clear()
+    paths.makedirs()
+    assert made == [os.path.join(str(tmp_path), 'a/plots/s')]
+    # moving a file doesn't forget its directory
+    paths.result_step.touch()
+    paths.result_step.move(str(tmp_path / 'moved.csv'))
+    made.clear()
+    paths.makedirs()
+    assert made == []
+
+
+def test_lazy_tree():
+    spec = {'{log_id}': {'model.h5': 'model', './plots//': {'{step}': {'': 'plot_dir'}}}, '/abs': 'abs'}
+    paths = pt.tree('logs', spec)
+    assert paths._paths.bound == {}  # nothing built yet
+    assert paths.model.path_pattern == '{root}/{log_id}/model.h5'
+    assert list(paths._paths.bound) == ['model']
+    # the same patterns pathlib would give
+    assert {k: p.path_pattern for k, p in paths.paths.items()} == {
+        v: str(pathlib.PurePath(*k)) for k, v in pt.path.get_keys({'{root}': {'': 'root', **spec}})}
+
+    assert 'example' not in vars(pt.path)  # built on first access
+    assert pt.path.example.flac.path_pattern == '{root}/data/{date}/flac/{name}.flac'
+    with pytest.raises(AttributeError):
+        pt.path.not_an_attribute
+
+
+def _model_file(paths):
+    return paths.model.format()
+
+
+def test_pickle_map(base_paths):
+    import pickle
+    paths = base_paths.specify(log_id='a')
+    paths.plot.update(plot_name='loss')
+    paths2 = pickle.loads(pickle.dumps(paths))
+    assert repr(paths2) == repr(paths)
+    assert paths2.plot.format(step_name='s') == 'logs/a/plots/s/loss.png'
+    assert paths2.plot.parent is paths2
+    # changes in place are still carried over to copies
+    assert paths2.specify(log_id='b').plot.format(step_name='s') == 'logs/b/plots/s/loss.png'
+
+    # copies share their path definitions in the pickle
+    copies = [base_paths.specify(log_id=i) for i in range(50)]
+    loaded = pickle.loads(pickle.dumps(copies))
+    assert loaded[0]._paths.source is loaded[1]._paths.source
+    assert [p.model.format() for p in loaded] == [p.model.format() for p in copies]
+    loaded[0].add('root', {'x.txt': 'x'})
+    assert 'x' in loaded[0] and 'x' not in loaded[1]
+
+    records = [{'log_id': i} for i in range(6)]
+    expected = ['logs/{}/model.h5'.format(i) for i in range(6)]
+    assert base_paths.map(_model_file, records, workers=2, backend='thread') == expected
+    assert base_paths.map(_model_file, records, workers=2, chunksize=2) == expected
+    with pytest.raises(ValueError):
+        base_paths.map(_model_file, records, backend='cluster')
+
+
+def test_index(tmp_path):
+    paths = pt.tree(str(tmp_path / 'tree'), {'data': {'{date}': {'{labels_set}.csv': 'csv', 'flac': {'{name}.flac': 'flac'}}}})
+    for date in ('2019-12-31', '2020-01-01', '2020-01-02'):
+        paths.csv.specify(date=date, labels_set='train').write('a,b')
+        for name in ('dog', 'cat'):
+            paths.flac.specify(date=date, name=name).write(b'1234')
+
+    db = str(tmp_path / 'files.db')
+    index = paths.index('flac', 'csv', db=db)
+    assert index.count() == 9 and index.count('flac') == 6
+    assert index.query('flac', date='2020-*', name='cat') == [
+        (paths.flac.format(date=d, name='cat'), {'root': str(tmp_path / 'tree'), 'date': d, 'name': 'cat'})
+        for d in ('2020-01-01', '2020-01-02')]
+    assert index.files(date={'2019-12-31'}) == sorted(
+        [paths.csv.format(date='2019-12-31', labels_set='train')] +
+        [paths.flac.format(date='2019-12-31', name=n) for n in ('cat', 'dog')])
+    assert index.distinct('name') == ['cat', 'dog']
+    assert index.distinct('labels_set', date='2020-*') == ['train']
+    assert index.query(missing_field='x') == [] and index.distinct('missing_field') == []
+    index.close()
+
+    # answered from the database without the files
+    paths.root.rmtree(include=False)
+    with pt.path.FileIndex(db) as index:
+        assert index.count('flac', date=['2020-01-01', '2020-01-02']) == 4
+        row = index.conn.execute('SELECT _size FROM files WHERE _name = ?', ('flac',)).fetchone()
+        assert row == (4,)
+
+
+def test_listing_refresh(tmp_path, monkeypatch):
+    monkeypatch.setattr(pt.path.Listing, 'RACY', 0)
+    paths = pt.tree(str(tmp_path / 'tree'), {'data': {'{date}': {'flac': {'{name}.flac': 'flac'}}}})
+    for date in ('a', 'b', 'c'):
+        for name in ('x', 'y'):
+            paths.flac.specify(date=date, name=name).touch()
+
+    listing = paths.flac.listing('flac')
+    assert len(listing.files) == 6 and len(listing.dirs) == 4
+    index = paths.index('flac', db=str(tmp_path / 'files.db'))
+
+    listed = []
+    scandir = os.scandir
+    monkeypatch.setattr(os, 'scandir', lambda d='.': listed.append(d) or scandir(d))
+    assert listing.refresh() == {'added': [], 'removed': []}
+    assert listed == []  # nothing changed, nothing listed
+
+    time.sleep(0.01)
+    paths.flac.specify(date='b', name='z').touch()
+    paths.flac.specify(date='c', name='x').rm()
+    paths.flac.specify(date='d', name='x').touch()
+    changes = listing.refresh()
+    f = lambda date, name: paths.flac.format(date=date, name=name)
+    assert [(n, p) for n, p, _ in changes['added']] == [('flac', f('b', 'z')), ('flac', f('d', 'x'))]
+    assert [(n, p, d['date']) for n, p, d in changes['removed']] == [('flac', f('c', 'x'), 'c')]
+    # only the directories that changed: data/ (new date), and b/flac, c/flac, d/flac
+    assert sorted(listed) == sorted([str(tmp_path / 'tree' / 'data')] + [os.path.dirname(f(d, 'x')) for d in 'bcd'])
+
+    # the index refreshes the same way
+    changes2 = index.refresh(paths)
+    assert [x[:2] for x in changes2['added']] == [x[:2] for x in changes['added']]
+    assert [x[:2] for x in changes2['removed']] == [x[:2] for x in changes['removed']]
+    assert index.files('flac', date='b') == [f('b', n) for n in 'xyz']
+    assert index.refresh(paths) == {'added': [], 'removed': []}
+
+    paths.flac.specify(date='a', name='x').up().rmtree()
+    assert [p for _, p, _ in index.refresh(paths)['removed']] == [f('a', 'x'), f('a', 'y')]
+    assert index.distinct('date') == ['b', 'c', 'd']
+
+
+def test_translate_many(paths):
+    paths = paths.specify(step_name='s')
+    plots = [paths.plot.format(plot_name=n) for n in ('a', 'b')]
+    out = list(paths.translate_many(plots, 'plot', 'plot_jpg'))
+    assert out == ['logs/a/plots/s/a.jpg', 'logs/a/plots/s/b.jpg']
+    assert out == [paths.translate(f, 'plot', 'plot_jpg').format() for f in plots]
+
+    # the target's own data is used for fields the source doesn't have
+    paths.model_step.update(step_name='other')
+    assert list(paths.translate_many(['logs/a/results/x.csv'], 'result_step', 'model_step', use_data=False)) == ['logs/a/models/x.h5']
+    assert list(paths.translate_many(plots[:1], 'plot', 'model_step')) == ['logs/a/models/s.h5']
+
+    bad = plots + ['logs/b/plots/s/c.png', 'nope.txt']
+    with pytest.raises(ValueError):
+        list(paths.translate_many(bad, 'plot', 'plot_jpg'))
+    assert list(paths.translate_many(bad, 'plot', 'plot_jpg', errors='skip')) == out
+    assert list(paths.translate_many(bad, 'plot', 'plot_jpg', errors='none')) == out + [None, None]
+    assert list(paths.translate_many(bad, 'plot', 'plot_jpg', use_data=False, errors='none'))[2] == 'logs/b/plots/s/c.jpg'
+    with pytest.raises(pt.UnderspecifiedError):
+        list(paths.unspecify('step_name').translate_many(['logs/a/model.h5'], 'model', 'plot'))
+
+
+@pytest.mark.parametrize('workers', [0, 4])
+def test_migrate(tmp_path, workers):
+    paths = pt.tree(str(tmp_path), {'{log_id}': {
+        'plots/{step}/{name}.png': 'plot',
+        'figures/{name}/{step}.png': 'figure',
+        'copies/{name}-{step}.png': 'dup',
+    }})
+    for log_id, step, name in ((l, s, n) for l in 'ab' for s in '12' for n in 'xyz'):
+        paths.plot.specify(log_id=log_id, step=step, name=name).write(log_id + step + name)
+
+    journal = str(tmp_path / 'dup.jsonl')
+    assert paths.migrate('plot', 'dup', mode='copy', workers=workers, journal=journal, chunk=5) == {'files': 12, 'skipped': 0}
+    assert paths.dup.specify(log_id='b', step='2', name='x').read() == 'b2x'
+    assert len(open(journal).readlines()) == 12
+    # resumed from the journal
+    os.remove(paths.dup.format(log_id='a', step='1', name='y'))
+    assert paths.migrate('plot', 'dup', mode='copy', journal=journal) == {'files': 0, 'skipped': 12}
+    assert not paths.dup.specify(log_id='a', step='1', name='y').exists()
+
+    assert paths.migrate('dup', 'figure', mode='hardlink', workers=workers, log_id='a') == {'files': 5, 'skipped': 0}
+    assert os.path.samefile(paths.figure.format(log_id='a', step='1', name='x'), paths.dup.format(log_id='a', step='1', name='x'))
+
+    # the figures linked for 'a' are only replaced when asked
+    with pytest.raises(FileExistsError):
+        paths.migrate('plot', 'figure', workers=workers)
+    assert len(paths.plot.glob()) == 12
+    assert paths.migrate('plot', 'figure', workers=workers, overwrite=True) == {'files': 12, 'skipped': 0}
+    assert not paths.plot.glob()
+    assert len(paths.figure.glob()) == 12
+    assert paths.figure.specify(log_id='b', step='1', name='z').read() == 'b1z'
+    with pytest.raises(ValueError):
+        paths.migrate('plot', 'figure', mode='symlink')
+
+    # several files mapping to one destination fail before anything is moved
+    paths = pt.tree(str(tmp_path / 'c'), {'{log_id}': {'plots/{step}/{name}.png': 'plot', 'flat/{name}.png': 'flat'}})
+    for step, name in (('1', 'x'), ('2', 'x'), ('1', 'y'), ('2', 'y')):
+        paths.plot.specify(log_id='a', step=step, name=name).write(step + name)
+    with pytest.raises(ValueError):
+        paths.migrate('plot', 'flat', workers=workers, overwrite=True)
+    assert len(paths.plot.glob()) == 4 and not paths.flat.glob()
+    # across chunks, the earlier chunks have run but nothing is lost
+    with pytest.raises(ValueError):
+        paths.migrate('plot', 'flat', workers=workers, chunk=1, overwrite=True)
+    assert len(paths.plot.glob()) + len(paths.flat.glob()) == 4
+
+    # files that don't parse are left alone
+    paths = pt.tree(str(tmp_path / 'n'), {'{log_id}': {'in/{i:d}.txt': 'src', 'out/{i:03d}.txt': 'dst'}})
+    for i in range(3):
+        paths.src.specify(log_id='a', i=i).write(str(i))
+    paths.src.up().specify(log_id='a').join('notes.txt').write('notes')
+    assert paths.migrate('src', 'dst', mode='copy', workers=workers) == {'files': 3, 'skipped': 0}
+    assert paths.dst.specify(log_id='a', i=2).read() == '2'
+    # destination dirs removed between runs are created again
+    import shutil
+    shutil.rmtree(paths.dst.up().format(log_id='a'))
+    assert paths.migrate('src', 'dst', workers=workers) == {'files': 3, 'skipped': 0}
+    assert paths.dst.glob() and os.listdir(paths.src.up().format(log_id='a')) == ['notes.txt']
+
+
+def test_writers(tmp_path, monkeypatch):
+    paths = pt.tree(str(tmp_path), {'{log_id}': {'results/{step_name}.csv': 'result_step'}})
+    paths.update(log_id='a')
+    makedirs = []
+    monkeypatch.setattr(pt.path, 'makedirs', lambda ds, cache: makedirs.extend(ds) or os.makedirs(ds[0], exist_ok=True))
+
+    with paths.writers(max_open=2, flush_every=None) as pool:
+        for i in range(3):
+            for name in 'xyz':
+                pool.append(paths.result_step, '{},{}'.format(name, i), step_name=name)
+            pool.append(paths.result_step, 'b\n', log_id='b', step_name='x')
+        assert len(pool.files) == 2
+        # evicted files were closed, the last line is buffered until flushed
+        assert paths.result_step.specify(step_name='z').read() == 'z,0\nz,1\n'
+        pool.flush()
+        assert paths.result_step.specify(step_name='z').read() == 'z,0\nz,1\nz,2\n'
+        pool.close(paths.result_step, step_name='z')
+        assert len(pool.files) == 1
+    assert not pool.files
+    assert paths.result_step.specify(step_name='x').read() == 'x,0\nx,1\nx,2\n'
+    assert open(paths.result_step.format(log_id='b', step_name='x')).read() == 'b\nb\nb\n'
+    # each directory is only created once
+    assert sorted(makedirs) == sorted({os.path.dirname(paths.result_step.format(log_id=l, step_name='x')) for l in 'ab'})
+
+    with paths.writers(flush_every=0) as pool:
+        pool.append(paths.result_step.specify(step_name='y'), 'y,3')
+        assert paths.result_step.specify(step_name='y').read().endswith('y,3\n')
+        assert (pool.hits, pool.misses) == (0, 1)
+    with pytest.raises(ValueError):
+        paths.writers(max_open=0)
+
+
+def test_snapshot(tmp_path, monkeypatch):
+    paths = pt.tree(str(tmp_path), {'{log_id}': {'{step}.csv': 'step', '': 'log'}})
+    paths.step.specify(log_id='a', step=1).touch()
+
+    with paths.snapshot() as cache:
+        assert paths.step.specify(log_id='a', step=1).is_file()
+        assert not paths.step.specify(log_id='a', step=2).exists()
+        # repeated checks don't hit the filesystem
+        monkeypatch.setattr(os, 'stat', None)
+        assert paths.step.specify(log_id='a', step=1).exists()
+        assert not paths.step.specify(log_id='a', step=2).exists()
+        monkeypatch.undo()
+
+        # writing through pathtree drops the stale entry
+        paths.step.specify(log_id='a', step=2).write('x')
+        assert paths.step.specify(log_id='a', step=2).is_file()
+        paths.step.specify(log_id='a', step=2).rm()
+        assert not paths.step.specify(log_id='a', step=2).exists()
+
+        # scan fills the cache from the directory listing
+        assert [d['step'] for _, d in paths.step.scan()] == ['1']
+        assert cache.entries[os.path.join(str(tmp_path), 'a')][1] == 'dir'
+        assert paths.log.specify(log_id='a').is_dir()
+
+        # listings are reused until a write below them
+        scandir, listed = os.scandir, []
+        monkeypatch.setattr(os, 'scandir', lambda d: listed.append(d) or scandir(d))
+        assert [d['step'] for _, d in paths.step.scan()] == ['1']
+        assert listed == []
+        paths.step.specify(log_id='a', step=2).touch()
+        assert [d['step'] for _, d in paths.step.scan()] == ['1', '2']
+        assert listed == [str(tmp_path), os.path.join(str(tmp_path), 'a')]
+        monkeypatch.undo()
+
+    with paths.snapshot(ttl=0) as cache:
+        assert paths.step.specify(log_id='a', step=1).exists()
+        os.remove(paths.step.specify(log_id='a', step=1).format())
+        assert not paths.step.specify(log_id='a', step=1).exists()
+    assert pt.path.StatCache.active() is None
+
+    # a snapshot only applies to the thread (or task) that opened it
+    import threading, asyncio
+    f = paths.step.specify(log_id='a', step=3)
+    entered, created, seen = threading.Event(), threading.Event(), []
+    def snapshot():
+        with paths.snapshot():
+            seen.append(f.exists())
+            entered.set()
+            created.wait(5)
+            seen.append(f.exists())  # still cached here
+    t = threading.Thread(target=snapshot)
+    t.start()
+    entered.wait(5)
+    open(f.format(), 'w').close()
+    exists = f.exists()  # not using the other thread's cache
+    created.set()
+    t.join()
+    assert exists
+    assert seen == [False, False]
+    assert pt.path.StatCache.active() is None and not pt.path.StatCache._open
+
+    async def check():
+        with paths.snapshot() as cache:
+            assert await f.aexists()
+            assert await f.aexists() and cache.hits == 1
+    asyncio.run(check())
+
+
+def test_next_unique(tmp_path):
+    p = pt.Path(str(tmp_path / 'results.csv'))
+    assert p.next_unique() == p.next_unique(scan=True) == str(tmp_path / 'results.csv')
+    pt.path.forget_unique()
+
+    for name in ('results.csv', 'results_01.csv', 'results_07.csv', 'results_x.csv'):
+        (tmp_path / name).touch()
+    assert p.next_unique() == str(tmp_path / 'results_02.csv')
+    # the scan takes the index after the largest one, then counts up without listing again
+    assert p.next_unique(scan=True) == str(tmp_path / 'results_08.csv')
+    (tmp_path / 'results_20.csv').touch()
+    assert p.next_unique(scan=True) == str(tmp_path / 'results_09.csv')
+    pt.path.forget_unique(p)
+    assert p.next_unique(scan=True) == str(tmp_path / 'results_21.csv')
+
+    pt.path.forget_unique()
+    fs = p.next_unique_many(3, create=True)
+    assert fs == [str(tmp_path / 'results_{:02}.csv'.format(i)) for i in (21, 22, 23)]
+    assert all(os.path.isfile(f) for f in fs)
+    # another process created the next one already
+    (tmp_path / 'results_24.csv').touch()
+    assert p.next_unique_many(2, create=True) == [str(tmp_path / 'results_25.csv'), str(tmp_path / 'results_26.csv')]
+    pt.path.forget_unique()
+
+
+@pytest.mark.parametrize('use_fd', [True, False])
+def test_rmtree(tmp_path, monkeypatch, use_fd):
+    monkeypatch.setattr(pt.path, '_RMTREE_FD', pt.path._RMTREE_FD and use_fd)
+    paths = pt.tree(str(tmp_path / 'exp'), {'{run}': {'{i}.txt': 'f', 'sub/deep': {'x.txt': 'x'}}})
+    for run in 'ab':
+        paths.x.specify(run=run).write('1234')
+        for i in range(5):
+            paths.f.specify(run=run, i=i).write('xy')
+    os.symlink(str(tmp_path), str(tmp_path / 'exp' / 'a' / 'link'))
+
+    root = paths.root
+    assert root.rmtree(dry_run=True) == {'files': 13, 'dirs': 7, 'bytes': 28 + len(os.readlink(str(tmp_path / 'exp' / 'a' / 'link')))}
+    assert paths.x.specify(run='a').exists()
+
+    assert root.rmtree(include=False, workers=2) == {'files': 13, 'dirs': 6}
+    assert os.listdir(str(tmp_path)) == ['exp']  # the symlink wasn't followed
+    assert os.listdir(str(tmp_path / 'exp')) == []
+
+    paths.x.specify(run='a').write('1')
+    root.rmglob(include=True)
+    assert not root.exists()
+
+
+def test_stats(tmp_path):
+    paths = pt.tree(str(tmp_path), {'{log_id}': {'{step}.csv': 'step'}}).specify(log_id='a')
+    format = pt.Path.format
+    calls = []
+    assert paths.stats()['ops'] == {}
+
+    with pt.path.instrument.enable(hook=lambda op, t: calls.append(op)):
+        assert pt.Path.format is not format
+        for i in range(3):
+            paths.step.specify(step=i).write('x')
+        paths.step.parse(paths.step.format(step=0))
+        with paths.snapshot():
+            paths.step.specify(step=0).exists()
+            paths.step.specify(step=0).exists()
+        paths.makedirs()
+    assert pt.Path.format is format  # unwrapped
+
+    stats = paths.stats()
+    assert stats['ops']['write']['calls'] == 3 and stats['ops']['parse']['timed'] == 1
+    assert stats['ops']['format']['calls'] >= 6 and stats['ops']['format']['mean'] > 0
+    assert stats['ops']['Paths.makedirs']['calls'] == stats['ops']['makedirs']['calls'] == 1
+    assert stats['fs']['mkdir'] == 3 and stats['fs']['stat'] == 1
+    assert stats['caches']['stat_cache'] == {'hits': 1, 'misses': 1, 'hit_rate': 0.5}
+    assert stats['caches']['compile_pattern']['hits'] > 0
+    assert stats['caches']['makedirs'] == {'hits': 1, 'misses': 0, 'hit_rate': 1.0}
+    assert calls.count('write') == 3
+
+    paths.step.specify(step=0).write('y')  # not recorded
+    assert paths.stats(reset=True)['ops']['write']['calls'] == 3
+    assert paths.stats()['ops'] == {}
+
+    # glob, rglob and file I/O are counted too
+    with pt.path.instrument.enable():
+        assert len(paths.step.glob()) == 3
+        assert len(list(paths.root.rglob())) == 4
+        assert paths.step.specify(step=1).read() == 'x'
+        paths.step.specify(step=3).write_text('x')
+        paths.step.specify(step=4).touch()
+        with pt.path.WriterPool() as pool:
+            pool.append(paths.step.specify(step=5), 'a')
+            pool.append(paths.step.specify(step=5), 'b')
+    stats = paths.stats(reset=True)
+    assert stats['fs']['listdir'] >= 3 and stats['fs']['open'] == 4
+    assert stats['caches']['writer_pool'] == {'hits': 1, 'misses': 1, 'hit_rate': 0.5}
+
+    # sampling counts every call but only times some
+    with pt.path.instrument.enable(sample=2):
+        for i in range(5):
+            paths.step.format(step=i)
+    assert paths.stats()['ops']['format']['calls'] == 5
+    assert paths.stats()['ops']['format']['timed'] == 2
+
+
+def test_read_write_many(tmp_path, monkeypatch):
+    paths = pt.tree(str(tmp_path), {'{log_id}': {'{step}.csv': 'step', '{step}.bin': 'step_bin'}})
+    made = []
+    makedir = pt.path._makedir
+    monkeypatch.setattr(pt.path, '_makedir', lambda d: made.append(d) or makedir(d))
+
+    items = [({'log_id': i % 2, 'step': i}, 'step {}'.format(i)) for i in range(20)]
+    files = paths.write_many('step', items, workers=4)
+    assert files == [paths.step.format(log_id=i % 2, step=i) for i in range(20)]
+    assert sorted(made) == [str(tmp_path / '0'), str(tmp_path / '1')]
+
+    data = [d for d, _ in items]
+    assert list(paths.read_many('step', data)) == items
+    assert sorted(paths.read_many('step', data, ordered=False), key=lambda x: x[0]['step']) == items
+
+    paths.step_bin.write_many([({'log_id': 0, 'step': 0}, b'\x00\x01')])
+    assert paths.step_bin.specify(log_id=0, step=0).read('b') == b'\x00\x01'
+    assert list(paths.step_bin.read_many([{'log_id': 0, 'step': 0}], mode='b')) == [({'log_id': 0, 'step': 0}, b'\x00\x01')]
+    paths.step_bin.specify(log_id=0, step=1).write(b'abc')
+    assert paths.step_bin.specify(log_id=0, step=1).read_bytes() == b'abc'
+
+    # directories removed behind pathtree's back are created again
+    import shutil
+    shutil.rmtree(str(tmp_path / '1'))
+    paths.write_many('step', items[1:2])
+    assert paths.step.specify(log_id=1, step=1).read() == 'step 1'
+
+
+def test_mmap(tmp_path):
+    import array
+    paths = pt.tree(str(tmp_path), {'{i}.bin': 'bin'})
+    for i in range(3):
+        paths.bin.specify(i=i).write(bytes(range(i * 4, i * 4 + 4)))
+    paths.bin.specify(i='empty').write(b'')
+
+    p = paths.bin.specify(i=1)
+    with p.mmap() as m:
+        assert m[:] == b'\x04\x05\x06\x07'
+        view = memoryview(m)  # still exported when the block exits
+    del view
+    with p.mmap('r+') as m:
+        m[0] = 9
+    with p.mmap('c') as m:
+        m[1] = 9
+        assert m[:2] == b'\x09\x09'
+    assert p.read('b') == b'\x09\x05\x06\x07'
+    with pytest.raises(ValueError):
+        with p.mmap('w'):
+            pass
+    assert p.read('b') == b'\x09\x05\x06\x07'
+
+    buf = bytearray(3)
+    assert p.read_into(buf, offset=1) == 3 and buf == b'\x05\x06\x07'
+    arr = array.array('h', [0, 0, 0])
+    assert p.read_into(arr) == 4 and arr.tolist()[2] == 0
+
+    with paths.mmap_glob('bin') as ms:
+        assert sorted(len(m) for m in ms.values()) == [0, 4, 4, 4]
+    with paths.bin.mmap_glob(i={0, 2}) as ms:
+        assert [m[0] for m in ms.values()] == [0, 8]
+
+
+def test_async(tmp_path):
+    import asyncio
+    paths = pt.tree(str(tmp_path), {'{log_id}': {'{step}.csv': 'step', 'meta.json': 'meta'}}).specify(log_id='a')
+
+    async def main():
+        steps = [paths.step.specify(step=i) for i in range(40)]
+        await paths.awrite_many([(p, 'step {}'.format(i)) for i, p in enumerate(steps)], limit=4)
+        assert await paths.aread_many(steps[:3]) == ['step 0', 'step 1', 'step 2']
+        assert await paths.aexists('meta', steps[0]) == {'meta': False, steps[0]: True}
+        assert await paths.aexists() == {'meta': False, 'root': True}
+
+        meta = await paths.meta.awrite({'a': 1})
+        assert await meta.aread() == "{'a': 1}"
+        assert await meta.ais_file() and not await meta.ais_dir()
+        await paths.step.specify(log_id='b', step=0).atouch()
+
+        files = [f async for f in paths.step.aglob()]
+        assert files == paths.step.glob() and len(files) == 40
+        assert sorted([f async for f in paths.step.aiglob(step={0, 1})]) == files[:2]
+        assert len([f async for f in paths.root.arglob()]) == 44
+        assert len(await paths.aglobs('step', 'meta')) == 41
+
+    asyncio.run(main())
+
 
 def test_read_write(paths_rw):
     pm = paths_rw.specify(step_name='step_nonexistant').model_step
@@ -244,3 +1008,26 @@ def test_read_write(paths_rw):
 def test_misc():
     f = 'a/b/c'
     assert pt.path.fbase(f, 1) == 'b'
+
+
+def test_template():
+    from pformat import pformat, gformat
+    patterns = ['{root}/epoch_{i_epoch:04d}/{name!r}.png', '{{lit}}/{a.real}/{b[0]}', 'plain/path', '{}/x']
+    datas = [{}, {'root': 'logs', 'i_epoch': 5}, {'a': 3, 'b': [9], 'name': 'x'}]
+    for pattern in patterns:
+        t = pt.path.compile_pattern(pattern)
+        assert t is pt.path.compile_pattern(pattern)
+        for d in datas:
+            assert t.partial_format((d,)) == pformat(pattern, **d)
+            assert t.glob_format((d,)) == gformat(pattern, **d)
+
+    t = pt.path.compile_pattern('{root}/epoch_{i_epoch:04d}/{name}.png')
+    assert t.fields == {'root', 'i_epoch', 'name'}
+    assert t.format(({'name': 'b'}, {'root': 'logs', 'i_epoch': 5, 'name': 'a'})) == 'logs/epoch_0005/b.png'
+    with pytest.raises(KeyError):
+        t.format(({'root': 'logs'},))
+
+    p = pt.Path('{root}/epoch_{i_epoch:04d}/{name}.png', data={'root': 'logs'})
+    assert p.format_only(i_epoch=3) == '{root}/epoch_0003/{name}.png'
+    assert p.maybe_format(i_epoch=3, name='a') == 'logs/epoch_0003/a.png'
+    assert isinstance(p.maybe_format(i_epoch=3), pt.Path)